@@ -0,0 +1,166 @@
+"""Results kept between runs in an SQLite database"""
+
+import contextlib
+import json
+import os
+import os.path
+import sqlite3
+import stat
+import sys
+import time
+
+# seconds to wait for another run to finish writing to the cache
+CACHE_TIMEOUT = 5
+
+
+def default_cache_filename(name):
+    """Location of the cache of a tool, following the XDG base directory specification"""
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_dir, 'thefoxUtils', f'{name}.sqlite')
+
+
+def add_cache_arguments(parser, name, help):
+    """Add the options to use a cache, which is only used when asked for, as args.cache"""
+    parser.add_argument('--cache', help=help, action='store_const', const=default_cache_filename(name))
+    parser.add_argument('--cache-file', help='keep the cache in FILE instead of the default location, implies --cache',
+                        dest='cache', metavar='FILE')
+
+
+class Cache:
+    """An SQLite database of results, with tables that are made again when the version changes
+
+    Changes are made in short transactions, so several runs can share the cache.
+    If the cache cannot be used, a warning is given and the run carries on without keeping its results.
+    """
+
+    version = 1
+
+    # statement to create each table, by name
+    tables = {}
+
+    def __init__(self, cache_filename):
+        self.cache_filename = cache_filename
+        self.warned = False
+        try:
+            self.connection = self.connect(cache_filename)
+        except (OSError, sqlite3.Error) as error:
+            self.warn(error)
+            self.connection = self.connect(':memory:')
+
+    def connect(self, cache_filename):
+        """Open the database, making the tables if they do not exist or have an old version"""
+
+        cache_dir = os.path.dirname(cache_filename)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        connection = sqlite3.connect(cache_filename, timeout=CACHE_TIMEOUT)
+        try:
+            # runs can read the cache while another run is writing to it
+            connection.execute('PRAGMA journal_mode = WAL')
+            (user_version,) = connection.execute('PRAGMA user_version').fetchone()
+            if user_version != self.version:
+                for table in self.tables:
+                    connection.execute(f'DROP TABLE IF EXISTS {table}')
+                connection.execute(f'PRAGMA user_version = {self.version}')
+            for create in self.tables.values():
+                connection.execute(create)
+            connection.commit()
+        except sqlite3.Error:
+            connection.close()
+            raise
+        return connection
+
+    def warn(self, error):
+        """Report that the cache could not be used, once per run"""
+
+        if not self.warned:
+            prog = os.path.basename(sys.argv[0])
+            print(f'{prog}: carrying on without the cache {self.cache_filename}: {error}', file=sys.stderr)
+            self.warned = True
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Make changes in one transaction, which are dropped if another run has the cache locked for too long"""
+
+        try:
+            yield self.connection
+            self.connection.commit()
+        except sqlite3.OperationalError as error:
+            self.connection.rollback()
+            self.warn(error)
+
+    def prune(self, table, size):
+        """Remove the least recently used rows of the table over the size, in a transaction already started
+
+        Rows used at the same time are kept or removed together.
+        """
+
+        self.connection.execute(f'DELETE FROM {table} WHERE used < '
+                                f'(SELECT used FROM {table} ORDER BY used DESC LIMIT 1 OFFSET ?)', (size - 1,))
+
+    def close(self):
+        self.connection.close()
+
+
+class FileCache(Cache):
+    """Results for files kept between runs
+
+    Results are keyed by the absolute path of the file and the settings that change the result,
+    and are only used while the size and times of the file are unchanged.
+    The change time is checked as well as the modification time, since converting a file can keep its modification time.
+    Only regular files are cached, the contents of pipes and devices can change without their times changing.
+    Results, and the times cached results were used, are kept in memory until save is called.
+    """
+
+    # the table of results, and the number of results to keep in it
+    table = 'results'
+    size = 10000
+
+    def __init__(self, cache_filename, settings):
+        self.tables = {
+            self.table: f'CREATE TABLE IF NOT EXISTS {self.table} '
+                        '(path TEXT, settings TEXT, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, '
+                        'ctime_ns INTEGER NOT NULL, result TEXT NOT NULL, used REAL NOT NULL, '
+                        'PRIMARY KEY (path, settings)) WITHOUT ROWID',
+        }
+        super().__init__(cache_filename)
+        self.settings = settings
+        self.stats = dict()
+        self.used = []
+        self.results = []
+
+    def read(self, filename):
+        """Return the cached result for the file, or None if the file has changed"""
+
+        path = os.path.abspath(filename)
+        file_stat = os.stat(filename)
+        if not stat.S_ISREG(file_stat.st_mode):
+            return None
+        self.stats[path] = (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ctime_ns)
+        row = self.connection.execute(f'SELECT result FROM {self.table} WHERE path = ? AND settings = ? '
+                                      'AND size = ? AND mtime_ns = ? AND ctime_ns = ?',
+                                      (path, self.settings) + self.stats[path]).fetchone()
+        if row is None:
+            return None
+        self.used.append(path)
+        return json.loads(row[0])
+
+    def write(self, filename, result):
+        """Cache the result for the file, as it was when read was called"""
+
+        path = os.path.abspath(filename)
+        if path in self.stats:
+            self.results.append((path, self.settings) + self.stats[path] + (json.dumps(result),))
+
+    def save(self):
+        """Write the results, and remove the least recently used results over the size of the cache"""
+
+        used = time.time()
+        with self.transaction() as connection:
+            connection.executemany(f'UPDATE {self.table} SET used = ? WHERE path = ? AND settings = ?',
+                                   ((used, path, self.settings) for path in self.used))
+            connection.executemany(f'INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                   (result + (used,) for result in self.results))
+            self.prune(self.table, self.size)
+        self.used = []
+        self.results = []
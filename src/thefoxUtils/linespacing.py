@@ -1,8 +1,17 @@
 #!/usr/bin/python3
 
 import argparse
+import bisect
+import concurrent.futures
+import contextlib
 import glob
+import hashlib
+import heapq
+import itertools
+import json
+import math
 import os.path
+import unicodedata
 
 import tabulate
 import uharfbuzz as hb
@@ -11,6 +20,24 @@ from fontTools.ttLib import TTFont
 import fontParts.world as fontparts
 
 from thefoxUtils import version, unidump
+from thefoxUtils.cache import Cache, add_cache_arguments
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+FEATURES = {}
+
+# number of texts to shape before measuring their glyphs with NumPy,
+# or before checking which texts can be pruned
+BATCH_SIZE = 1000
+
+# number of lines to read before shaping them, since most lines of a corpus are distinct
+LINE_BATCH_SIZE = 10 * BATCH_SIZE
+
+# result for a text that was not shaped since it could not be an extrema
+PRUNED = False
 
 
 def main():
@@ -18,22 +45,86 @@ def main():
     parser.add_argument('fonts', help='fonts to read', nargs='+')
     parser.add_argument('-t', '--test', help='directory of test data (repeatable)', action='append')
     parser.add_argument('-n', '--records', help='output last number of extrema', default=10, type=int)
+    parser.add_argument('-j', '--jobs', help='number of processes to shape with', default=1, type=int)
+    parser.add_argument('-l', '--lines', help='shape whole lines instead of each word', action='store_true')
+    parser.add_argument('-p', '--prune', help='do not shape words that cannot be extrema', action='store_true')
+    parser.add_argument('-a', '--location', help='axis location of variable fonts, such as wght=700,wdth=100 (repeatable)',
+                        action='append', type=parse_location, default=[])
+    parser.add_argument('-g', '--grid', help='axis values of variable fonts, such as wght=100:900:100 (repeatable)',
+                        action='append', type=parse_grid, default=[])
+    add_cache_arguments(parser, 'linespacing', 'reuse the results of shaping texts with fonts that have not changed')
     parser.add_argument('--version', action='version', version='%(prog)s ' + version)
     args = parser.parse_args()
 
-    test_words = []
-    if args.test:
-        for test_dir in args.test:
-            test_words += find_words(test_dir)
-    lowest_extremas, highest_extremas = find_extrema(test_words, args.fonts)
+    text_files = find_text_files(args.test)
+    locations = args.location + grid_locations(args.grid)
+    cache = ShapingCache(args.cache, shaping_settings(args.lines)) if args.cache else None
+    lowest_extremas, highest_extremas, font_extremas = find_extrema(text_files, args.fonts, args.records, args.jobs,
+                                                                    cache, args.lines, args.prune, locations)
+    if cache:
+        cache.close()
     report(lowest_extremas, args.records)
     report(highest_extremas, args.records)
-    show(lowest_extremas, highest_extremas, args.fonts)
+    show(lowest_extremas, highest_extremas, font_extremas, args.fonts, locations)
+
+
+def parse_location(location):
+    """Parse an axis location such as wght=700,wdth=100 into sorted (tag, value) pairs"""
+
+    coordinates = dict()
+    for coordinate in location.split(','):
+        tag, sep, value = coordinate.partition('=')
+        try:
+            coordinates[tag.strip()] = float(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f'axis location {coordinate} is not of the form tag=value')
+    return tuple(sorted(coordinates.items()))
+
+
+def parse_grid(grid):
+    """Parse axis values such as wght=100:900:100 into the tag and a list of values"""
+
+    tag, sep, values = grid.partition('=')
+    try:
+        start, stop, step = [float(value) for value in values.split(':')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'axis values {grid} are not of the form tag=start:stop:step')
+    if step <= 0:
+        raise argparse.ArgumentTypeError(f'axis values {grid} need a step greater than zero')
+    count = math.floor((stop - start) / step + 1e-9) + 1
+    return tag.strip(), [start + step * index for index in range(count)]
+
+
+def grid_locations(grids):
+    """Make the locations of every combination of axis values"""
+
+    if not grids:
+        return []
+    tags = [tag for tag, values in grids]
+    locations = []
+    for values in itertools.product(*[values for tag, values in grids]):
+        locations.append(tuple(sorted(zip(tags, values))))
+    return locations
+
+
+def location_name(location):
+    """Name an axis location for display"""
+    return ','.join(f'{tag}={value:g}' for tag, value in location)
+
+
+def instance_name(font_filename, location):
+    """Name a font at an axis location for display"""
+
+    if location:
+        return f'{font_filename} {location_name(location)}'
+    return font_filename
 
 
 class TestWord():
     """Test word"""
 
+    __slots__ = ('text', 'line_num', 'word_num', 'text_filename')
+
     def __init__(self, text, line_num, word_num, text_filename):
         self.text = text
         self.line_num = line_num
@@ -41,86 +132,707 @@ class TestWord():
         self.text_filename = text_filename
 
 
-def find_words(test_dir):
-    """Make a list of words from the text"""
+def find_text_files(test_dirs):
+    """Make a list of the text files in the directories of test data"""
 
-    if not test_dir:
-        return []
-    test_words = []
-    text_files = glob.glob('**/*.*txt', root_dir=test_dir, recursive=True)
-    for text_file in text_files:
-        print(f'Reading {text_file}')
+    text_files = []
+    if test_dirs:
+        for test_dir in test_dirs:
+            if not test_dir:
+                continue
+            for text_file in glob.glob('**/*.*txt', root_dir=test_dir, recursive=True):
+                text_files.append((test_dir, text_file))
+    return text_files
+
+
+def read_lines(text_files, announce=True):
+    """Read the words of each line of the text files, one line at a time"""
+
+    for test_dir, text_file in text_files:
+        if announce:
+            print(f'Reading {text_file}')
         with open(os.path.join(test_dir, text_file), encoding='utf-8') as text:
-            line_num = 1
-            for line in text:
-                words = line.split()
-                word_num = 1
-                for word in words:
-                    test_word = TestWord(word, line_num, word_num, text_file)
-                    test_words.append(test_word)
-                    word_num += 1
-                line_num += 1
-    return test_words
-
-
-def find_extrema(test_words, font_filenames):
-    """Find extrema in TTF files"""
-
-    if not test_words:
-        return [], []
-    lowest_extremas = []
-    highest_extremas = []
-    lowest = 1000
-    highest = -1000
+            for line_num, line in enumerate(text, start=1):
+                yield text_file, line_num, line.split()
+
+
+def read_texts(text_files, lines=False, batch_lines=None):
+    """Find the distinct words, or lines, in the text files, in order of first occurrence
+
+    The text of a line is its words separated by single spaces.
+    If a number of lines is given, the texts are found in batches of that many lines,
+    so only the texts of one batch are kept at a time, and texts are only distinct within a batch.
+    Yield the distinct texts of each batch and the number of words read for them.
+    """
+
+    texts = dict()
+    word_count = 0
+    for line_count, (text_file, line_num, words) in enumerate(read_lines(text_files), start=1):
+        if lines:
+            if words:
+                texts[' '.join(words)] = None
+        else:
+            for word in words:
+                texts[word] = None
+        word_count += len(words)
+        if batch_lines and line_count % batch_lines == 0 and texts:
+            yield list(texts), word_count
+            texts = dict()
+            word_count = 0
+    if texts:
+        yield list(texts), word_count
+
+
+def find_extrema(text_files, font_filenames, records=10, jobs=1, cache=None, lines=False, prune=False, locations=None):
+    """Find extrema in TTF files
+
+    The text files are read twice, once to find the distinct texts to shape,
+    and once more to find where the texts with extreme levels occur.
+    Lines are shaped in batches as they are read, keeping only the candidates of each batch.
+    When pruning, texts that cannot be among the records are not shaped.
+    Each font is measured at each axis location, or at its default location if none are given.
+    Return the lowest and highest extremas over all the fonts,
+    and a dictionary of the lowest and highest extremas of each (font, location) instance.
+    """
+
+    kind = 'lines' if lines else 'words'
+    instances = []
     for font_filename in font_filenames:
-        root, ext = os.path.splitext(font_filename)
-        if ext == '.ufo':
-            continue
-        print(f'Processing {font_filename}')
-        font = TTFont(font_filename)
+        if os.path.splitext(font_filename)[1] != '.ufo':
+            for location in locations or [()]:
+                instances.append((font_filename, location))
+    font_candidates = dict()
+    for instance in instances:
+        font_candidates[instance] = (Candidates(records), Candidates(records, highest=True))
+    prune_records = records if prune else None
+    word_count = 0
+    texts_read = 0
+    # a line found again in a later batch is another occurrence of it, so it can be added to the candidates again
+    batch_lines = LINE_BATCH_SIZE if lines else None
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else contextlib.nullcontext()
+    with pool as executor:
+        for texts, batch_word_count in read_texts(text_files, lines, batch_lines):
+            word_count += batch_word_count
+            print(f'Shaping {len(texts)} distinct {kind} from {batch_word_count} words')
+            # texts found in the cache are measured first, so order ties by where the texts occur
+            orders = {text: texts_read + index for index, text in enumerate(texts)}
+            texts_read += len(texts)
+            extremes = dict()
+            for instance, (lowest, highest) in font_candidates.items():
+                extremes[instance] = (lowest.extremes(), highest.extremes())
+            for instance, shard, results in measure_fonts(instances, texts, jobs, cache, lines, prune_records,
+                                                          executor, extremes):
+                lowest, highest = font_candidates[instance]
+                for text, result in zip(shard, results):
+                    if result is PRUNED:
+                        continue
+                    # a line has the extent of each of its words
+                    extents = result if lines else [result]
+                    for word_offset, extent in enumerate(extents):
+                        if extent is None:
+                            continue
+                        low, high = extent
+                        order = (orders[text], word_offset)
+                        lowest.add((text, word_offset), low, order)
+                        highest.add((text, word_offset), high, order)
+    if not word_count:
+        return [], [], {}
+
+    # find the occurrences of the candidates
+    font_records = dict()
+    occurrences = dict()
+    for instance_index, instance in enumerate(instances):
+        font_records[instance] = (ExtremaRecords(records), ExtremaRecords(records, highest=True))
+        for candidates, extrema_records in zip(font_candidates[instance], font_records[instance]):
+            for (text, word_offset), level in candidates.levels().items():
+                occurrences.setdefault(text, []).append((word_offset, instance_index, extrema_records, level))
+    position = 0
+    for text_file, line_num, words in read_lines(text_files, announce=False):
+        if lines:
+            found = occurrences.get(' '.join(words), [])
+        else:
+            found = []
+            for word_offset, word in enumerate(words):
+                for entry in occurrences.get(word, []):
+                    found.append((word_offset,) + entry[1:])
+        for word_offset, instance_index, extrema_records, level in found:
+            test_word = TestWord(words[word_offset], line_num, word_offset + 1, text_file)
+            # order ties by font, and then by where the word occurs
+            order = instance_index * word_count + position + word_offset
+            extrema_records.add(level, order, test_word, instance_name(*instances[instance_index]))
+        position += len(words)
 
+    lowest = ExtremaRecords(records)
+    highest = ExtremaRecords(records, highest=True)
+    font_extremas = dict()
+    for instance, (font_lowest, font_highest) in font_records.items():
+        lowest.update(font_lowest)
+        highest.update(font_highest)
+        font_extremas[instance] = (font_lowest.extremas(), font_highest.extremas())
+    return lowest.extremas(), highest.extremas(), font_extremas
+
+
+def measure_fonts(instances, texts, jobs, cache=None, lines=False, records=None, executor=None, extremes=None):
+    """Shape texts with each (font, location) instance, yielding the instances, texts and their extents
+
+    The texts are lines when lines is true, and each has a list of the extents of its words.
+    If the number of records is given, texts that cannot be among them are pruned,
+    allowing for the lowest and highest levels of other texts given for each instance in extremes.
+    Texts found in the cache are yielded first, and are not shaped again.
+    With more than one job the texts are split into shards,
+    and each (instance, shard) task is shaped in the pool of processes of the executor.
+    """
+
+    extremes = extremes or dict()
+    font_texts = dict()
+    for instance in instances:
+        font_texts[instance] = texts
+        if cache:
+            cached = cache.read(*instance, texts)
+            cached_texts = [text for text in texts if text in cached]
+            if cached_texts:
+                print(f'Found {len(cached_texts)} texts for {instance_name(*instance)} in the cache')
+                yield instance, cached_texts, [cached[text] for text in cached_texts]
+            font_texts[instance] = [text for text in texts if text not in cached]
+
+    if jobs <= 1:
+        for instance in instances:
+            if not font_texts[instance]:
+                continue
+            print(f'Processing {instance_name(*instance)}')
+            font_filename, location = instance
+            extents = measure_texts(font_filename, font_texts[instance], lines, records, location,
+                                    extremes.get(instance))
+            if cache:
+                cache.write(font_filename, location, font_texts[instance], extents)
+            yield instance, font_texts[instance], extents
+        return
+
+    # use a few shards per process so a slow shard does not hold up the others
+    shard_size = max(1, math.ceil(len(texts) / (jobs * 4)))
+    tasks = []
+    for instance in instances:
+        missing_texts = font_texts[instance]
+        for start in range(0, len(missing_texts), shard_size):
+            tasks.append((instance, missing_texts[start:start + shard_size]))
+    if not tasks:
+        return
+    task_instances, task_shards = zip(*tasks)
+    task_fonts, task_locations = zip(*task_instances)
+    task_extremes = [extremes.get(instance) for instance in task_instances]
+    results = executor.map(measure_texts, task_fonts, task_shards,
+                           [lines] * len(tasks), [records] * len(tasks), task_locations, task_extremes)
+    current_instance = None
+    for (instance, shard), extents in zip(tasks, results):
+        if instance != current_instance:
+            print(f'Processing {instance_name(*instance)}')
+            current_instance = instance
+        if cache:
+            cache.write(*instance, shard, extents)
+        yield instance, shard, extents
+
+
+shapers = dict()
+
+
+class Shaper:
+    """A font opened for shaping, with the glyph bounds at each axis location it is shaped at
+
+    A single HarfBuzz face is used for all the locations.
+    """
+
+    def __init__(self, font_filename):
+        self.font = TTFont(font_filename)
         hb_blob = hb.Blob.from_file_path(font_filename)
         hb_face = hb.Face(hb_blob)
-        hb_font = hb.Font(hb_face)
-
-        text_file = ''
-        for test_word in test_words:
-            if test_word.text_filename != text_file:
-                print(f'Shaping {test_word.text_filename}')
-                text_file = test_word.text_filename
-            buf = hb.Buffer()
-            buf.add_str(test_word.text)
-            buf.guess_segment_properties()
-            features = {}
-            hb.shape(hb_font, buf, features)
-            infos = buf.glyph_infos
-            positions = buf.glyph_positions
-            for info, position in zip(infos, positions):
-                glyph_set = font.getGlyphSet()
-                bp = BoundsPen(glyph_set)
-                gid = info.codepoint
-                glyph_name = hb_font.glyph_to_string(gid)
-                glyph = glyph_set[glyph_name]
-                glyph.draw(bp)
-                if bp.bounds is None:
+        self.hb_font = hb.Font(hb_face)
+        self.glyph_bounds = dict()
+        self.best_cases = dict()
+
+    def locate(self, location):
+        """Shape at an axis location from now on, and return the glyph bounds there"""
+
+        self.hb_font.set_variations(dict(location))
+        if location not in self.glyph_bounds:
+            self.glyph_bounds[location] = GlyphBounds(self.font, location)
+        return self.glyph_bounds[location]
+
+    def best_case(self, location):
+        """Return the best case extents of text at an axis location, or None if they are not known"""
+
+        # the offsets found from GPOS do not include variations
+        if location:
+            return None
+        if location not in self.best_cases:
+            self.best_cases[location] = BestCase(self.font, self.glyph_bounds[location])
+        return self.best_cases[location]
+
+
+def measure_texts(font_filename, texts, lines=False, records=None, location=(), extremes=None):
+    """Shape texts with a font and return the extent of each word, or the extents of each line
+
+    If the number of records is given, texts with a best case extent that
+    cannot reach the records of the texts shaped so far, or the lowest and highest levels
+    of other texts given in extremes, are not shaped, and have a result of PRUNED.
+    Fonts are opened once per process and reused for later calls.
+    """
+
+    if font_filename not in shapers:
+        shapers[font_filename] = Shaper(font_filename)
+    shaper = shapers[font_filename]
+    hb_font = shaper.hb_font
+    glyph_bounds = shaper.locate(location)
+    best_case = shaper.best_case(location) if records is not None else None
+    prune = best_case is not None and best_case.prunable
+    lowest_extremes, highest_extremes = extremes or ((), ())
+    lowest = Candidates(records or 0, extremes=lowest_extremes)
+    highest = Candidates(records or 0, highest=True, extremes=highest_extremes)
+    results = [PRUNED] * len(texts)
+    for start in range(0, len(texts), BATCH_SIZE):
+        indexes = []
+        for index in range(start, min(start + BATCH_SIZE, len(texts))):
+            if prune:
+                extent = best_case.extent(texts[index])
+                if extent is not None and not lowest.reachable(extent[0]) and not highest.reachable(extent[1]):
                     continue
-                (xmin, ymin, xmax, ymax) = bp.bounds
-                y_offset = position.y_offset
-                low = ymin + y_offset
-                high = ymax + y_offset
-                if low < lowest:
-                    lowest = low
-                    lowest_extremas = []
-                if low == lowest:
-                    extrema = Extrema(test_word, low, font_filename)
-                    lowest_extremas.append(extrema)
-                if high > highest:
-                    highest = high
-                    highest_extremas = []
-                if high == highest:
-                    extrema = Extrema(test_word, high, font_filename)
-                    highest_extremas.append(extrema)
-    return lowest_extremas, highest_extremas
+            indexes.append(index)
+        batch = [texts[index] for index in indexes]
+        if numpy is not None:
+            batch_results = measure_batch(hb_font, glyph_bounds, batch, lines)
+        elif lines:
+            batch_results = [line_extents(hb_font, glyph_bounds, text) for text in batch]
+        else:
+            batch_results = [word_extent(hb_font, glyph_bounds, text) for text in batch]
+        for index, result in zip(indexes, batch_results):
+            results[index] = result
+            if prune:
+                for word_offset, extent in enumerate(result if lines else [result]):
+                    if extent is not None:
+                        lowest.add((index, word_offset), extent[0])
+                        highest.add((index, word_offset), extent[1])
+    return results
+
+
+def shaping_settings(lines=False):
+    """Describe the settings that the results of shaping depend on"""
+    settings = {
+        'harfbuzz': hb.version_string(),
+        'features': FEATURES,
+        'script': 'guessed',
+        'language': 'guessed',
+        'lines': lines,
+    }
+    return settings
+
+
+def shape_text(hb_font, text):
+    """Shape text, with the characters added as codepoints so clusters are character indexes"""
+
+    buf = hb.Buffer()
+    buf.add_codepoints([ord(char) for char in text])
+    buf.guess_segment_properties()
+    hb.shape(hb_font, buf, FEATURES)
+    return buf
+
+
+def find_word_starts(text):
+    """Find the index of the start of each word in text separated by single spaces"""
+
+    word_starts = [0]
+    for index, char in enumerate(text):
+        if char == ' ':
+            word_starts.append(index + 1)
+    return word_starts
+
+
+def word_extent(hb_font, glyph_bounds, text):
+    """Shape a word and return the lowest and highest points of its glyphs"""
+
+    buf = shape_text(hb_font, text)
+    infos = buf.glyph_infos
+    positions = buf.glyph_positions
+    lowest = None
+    highest = None
+    for info, position in zip(infos, positions):
+        bounds = glyph_bounds[info.codepoint]
+        if bounds is None:
+            continue
+        (xmin, ymin, xmax, ymax) = bounds
+        y_offset = position.y_offset
+        low = ymin + y_offset
+        high = ymax + y_offset
+        if lowest is None or low < lowest:
+            lowest = low
+        if highest is None or high > highest:
+            highest = high
+    if lowest is None:
+        return None
+    return lowest, highest
+
+
+def line_extents(hb_font, glyph_bounds, text):
+    """Shape a line of words separated by single spaces, and return the extent of each word
+
+    Glyphs are attributed to words by their cluster, which is the index of the character they come from.
+    """
+
+    word_starts = find_word_starts(text)
+    buf = shape_text(hb_font, text)
+    extents = [None] * len(word_starts)
+    for info, position in zip(buf.glyph_infos, buf.glyph_positions):
+        bounds = glyph_bounds[info.codepoint]
+        if bounds is None:
+            continue
+        (xmin, ymin, xmax, ymax) = bounds
+        y_offset = position.y_offset
+        low = ymin + y_offset
+        high = ymax + y_offset
+        word = bisect.bisect_right(word_starts, info.cluster) - 1
+        if extents[word] is None:
+            extents[word] = (low, high)
+        else:
+            extents[word] = (min(low, extents[word][0]), max(high, extents[word][1]))
+    return extents
+
+
+def measure_batch(hb_font, glyph_bounds, texts, lines=False):
+    """Shape texts and find the extents of their words with NumPy
+
+    The glyph IDs and offsets of all the texts are collected into arrays,
+    along with the word each glyph belongs to, and the lowest and highest
+    points of each word are found with NumPy reductions.
+    """
+
+    gids = []
+    y_offsets = []
+    glyph_words = []
+    text_words = []
+    words = 0
+    for text in texts:
+        buf = shape_text(hb_font, text)
+        infos = buf.glyph_infos
+        gids += [info.codepoint for info in infos]
+        y_offsets += [position.y_offset for position in buf.glyph_positions]
+        if lines:
+            word_starts = find_word_starts(text)
+            glyph_words += [words + bisect.bisect_right(word_starts, info.cluster) - 1 for info in infos]
+            text_words.append(len(word_starts))
+            words += len(word_starts)
+        else:
+            glyph_words += [words] * len(infos)
+            words += 1
+
+    inked, ymins, ymaxs = glyph_bounds.arrays()
+    gids = numpy.array(gids, dtype=numpy.intp)
+    glyph_words = numpy.array(glyph_words, dtype=numpy.intp)
+    y_offsets = numpy.array(y_offsets, dtype=ymins.dtype)
+    inked_glyphs = inked[gids]
+    gids = gids[inked_glyphs]
+    glyph_words = glyph_words[inked_glyphs]
+    y_offsets = y_offsets[inked_glyphs]
+
+    if numpy.issubdtype(ymins.dtype, numpy.integer):
+        limits = numpy.iinfo(ymins.dtype)
+    else:
+        limits = numpy.finfo(ymins.dtype)
+    lows = numpy.full(words, limits.max, dtype=ymins.dtype)
+    highs = numpy.full(words, limits.min, dtype=ymins.dtype)
+    numpy.minimum.at(lows, glyph_words, ymins[gids] + y_offsets)
+    numpy.maximum.at(highs, glyph_words, ymaxs[gids] + y_offsets)
+    inked_words = numpy.zeros(words, dtype=bool)
+    inked_words[glyph_words] = True
+
+    lows = lows.tolist()
+    highs = highs.tolist()
+    if not numpy.issubdtype(ymins.dtype, numpy.integer):
+        # only some glyphs have bounds that are not integers, keep the integers of the others as they are without NumPy
+        lows = [int(low) if low.is_integer() else low for low in lows]
+        highs = [int(high) if high.is_integer() else high for high in highs]
+    extents = [(low, high) if inked_word else None
+               for low, high, inked_word in zip(lows, highs, inked_words.tolist())]
+    if not lines:
+        return extents
+    results = []
+    start = 0
+    for count in text_words:
+        results.append(extents[start:start + count])
+        start += count
+    return results
+
+
+class ShapingCache(Cache):
+    """Extents of shaped text kept between runs
+
+    Extents are keyed by a hash of the font contents, the shaping settings and axis location, and the text.
+    When the contents of a font file change, the extents for its old contents are removed.
+    """
+
+    version = 1
+    tables = {
+        'fonts': 'CREATE TABLE IF NOT EXISTS fonts (font_filename TEXT PRIMARY KEY, font_hash TEXT NOT NULL)',
+        'extents': 'CREATE TABLE IF NOT EXISTS extents '
+                   '(font_hash TEXT, settings TEXT, text TEXT, extent TEXT NOT NULL, '
+                   'PRIMARY KEY (font_hash, settings, text)) WITHOUT ROWID',
+    }
+
+    def __init__(self, cache_filename, settings):
+        super().__init__(cache_filename)
+        self.font_hashes = dict()
+        self.settings = settings
+
+    def font_hash(self, font_filename):
+        """Hash the font contents, and evict extents for the previous contents of the font file"""
+
+        if font_filename in self.font_hashes:
+            return self.font_hashes[font_filename]
+        with open(font_filename, 'rb') as font_file:
+            font_hash = hashlib.sha256(font_file.read()).hexdigest()
+        self.font_hashes[font_filename] = font_hash
+
+        path = os.path.abspath(font_filename)
+        with self.transaction() as connection:
+            row = connection.execute('SELECT font_hash FROM fonts WHERE font_filename = ?', (path,)).fetchone()
+            if row and row[0] != font_hash:
+                connection.execute('UPDATE fonts SET font_hash = ? WHERE font_filename = ?', (font_hash, path))
+                # another font file might have the same contents
+                connection.execute('DELETE FROM extents WHERE font_hash = ? AND font_hash NOT IN '
+                                   '(SELECT font_hash FROM fonts)', (row[0],))
+            elif row is None:
+                connection.execute('INSERT INTO fonts VALUES (?, ?)', (path, font_hash))
+        return font_hash
+
+    def location_settings(self, location):
+        """Describe the settings for shaping at an axis location"""
+
+        if not location:
+            return json.dumps(self.settings, sort_keys=True)
+        return json.dumps(dict(self.settings, location=dict(location)), sort_keys=True)
+
+    def read(self, font_filename, location, texts):
+        """Return a dictionary of the cached extents of the texts shaped with the font at an axis location"""
+
+        font_hash = self.font_hash(font_filename)
+        settings = self.location_settings(location)
+        extents = dict()
+        for text in texts:
+            row = self.connection.execute('SELECT extent FROM extents WHERE font_hash = ? AND settings = ? AND text = ?',
+                                          (font_hash, settings, text)).fetchone()
+            if row:
+                extents[text] = json.loads(row[0])
+        return extents
+
+    def write(self, font_filename, location, texts, extents):
+        """Cache the extents of texts shaped with the font at an axis location"""
+
+        font_hash = self.font_hash(font_filename)
+        settings = self.location_settings(location)
+        with self.transaction() as connection:
+            connection.executemany('INSERT OR REPLACE INTO extents VALUES (?, ?, ?, ?)',
+                                   ((font_hash, settings, text, json.dumps(extent))
+                                    for text, extent in zip(texts, extents) if extent is not PRUNED))
+
+
+class GlyphBounds:
+    """Bounds of the glyphs in a font, at an axis location if one is given, indexed by glyph ID"""
+
+    def __init__(self, font, location=()):
+        if location:
+            self.glyph_set = font.getGlyphSet(location=dict(location))
+        else:
+            self.glyph_set = font.getGlyphSet()
+        self.glyph_names = font.getGlyphOrder()
+        self.bounds = [False] * len(self.glyph_names)
+        self.ink_array = None
+        self.ymin_array = None
+        self.ymax_array = None
+
+    def __getitem__(self, gid):
+        bounds = self.bounds[gid]
+        if bounds is False:
+            bounds = self.calculate(gid)
+        return bounds
+
+    def __len__(self):
+        return len(self.bounds)
+
+    def calculate(self, gid):
+        """Draw a glyph to find its bounds, which are None for an empty glyph"""
+        bp = BoundsPen(self.glyph_set)
+        glyph_name = self.glyph_names[gid]
+        self.glyph_set[glyph_name].draw(bp)
+        self.bounds[gid] = bp.bounds
+        return bp.bounds
+
+    def calculate_all(self):
+        """Find the bounds of all the glyphs at once"""
+        for gid, bounds in enumerate(self.bounds):
+            if bounds is False:
+                self.calculate(gid)
+
+    def arrays(self):
+        """Return NumPy arrays of whether each glyph has ink, and of the bottom and top of each glyph"""
+
+        if self.ink_array is None:
+            self.calculate_all()
+            self.ink_array = numpy.array([bounds is not None for bounds in self.bounds], dtype=bool)
+            self.ymin_array = numpy.array([bounds[1] if bounds else 0 for bounds in self.bounds])
+            self.ymax_array = numpy.array([bounds[3] if bounds else 0 for bounds in self.bounds])
+            if self.ymin_array.dtype != self.ymax_array.dtype:
+                self.ymin_array = self.ymin_array.astype(float)
+                self.ymax_array = self.ymax_array.astype(float)
+        return self.ink_array, self.ymin_array, self.ymax_array
+
+
+class BestCase:
+    """Best case extents of text in a font, found without shaping
+
+    Each character can become any glyph that GSUB can substitute for its glyph in the cmap,
+    and can be moved up or down by the sum of the largest vertical adjustments of each GPOS lookup.
+    Marks can be moved by any amount, so text with marks has no best case,
+    nor does text with characters that might be composed or decomposed when shaping.
+    """
+
+    def __init__(self, font, glyph_bounds):
+        self.glyph_bounds = glyph_bounds
+        self.cmap = font.getBestCmap()
+        self.glyph_ids = font.getReverseGlyphMap()
+        self.substitutions = substitution_graph(font)
+        self.offset, self.marks = position_limits(font)
+        self.prunable = self.offset is not None and 'morx' not in font and 'kerx' not in font
+        self.char_extents = dict()
+        # dotted circles can be inserted for broken clusters
+        self.inserted_extent = self.char_extent('\u25CC') or (math.inf, -math.inf)
+
+    def glyph_extent(self, glyph_name):
+        """Find the lowest and highest points of the glyphs that GSUB can substitute for a glyph"""
+
+        low = math.inf
+        high = -math.inf
+        closure = {glyph_name}
+        pending = [glyph_name]
+        while pending:
+            glyph_name = pending.pop()
+            if glyph_name in self.marks:
+                return None
+            bounds = self.glyph_bounds[self.glyph_ids[glyph_name]]
+            if bounds is not None:
+                low = min(low, bounds[1])
+                high = max(high, bounds[3])
+            for substitute in self.substitutions.get(glyph_name, ()):
+                if substitute not in closure:
+                    closure.add(substitute)
+                    pending.append(substitute)
+        return low, high
+
+    def char_extent(self, char):
+        """Find the best case extent of a character, or None if it has none"""
+
+        if char not in self.char_extents:
+            extent = None
+            codepoint = ord(char)
+            hangul_jamo = 0x1100 <= codepoint <= 0x11FF or 0xA960 <= codepoint <= 0xA97F or 0xD7B0 <= codepoint <= 0xD7FF
+            # shapers can decompose characters with a canonical decomposition even if the font has a glyph for them
+            decomposition = unicodedata.decomposition(char)
+            decomposable = decomposition != '' and not decomposition.startswith('<')
+            mark = unicodedata.category(char).startswith('M')
+            if codepoint in self.cmap and not (mark or hangul_jamo or decomposable):
+                extent = self.glyph_extent(self.cmap[codepoint])
+            self.char_extents[char] = extent
+        return self.char_extents[char]
+
+    def extent(self, text):
+        """Find the best case extent of text, or None if it has none"""
+
+        low, high = self.inserted_extent
+        for char in text:
+            extent = self.char_extent(char)
+            if extent is None:
+                return None
+            low = min(low, extent[0])
+            high = max(high, extent[1])
+        return low - self.offset, high + self.offset
+
+
+def substitution_graph(font):
+    """Map each glyph to the glyphs that a GSUB lookup could substitute for it, ignoring context"""
+
+    graph = dict()
+
+    def add(glyph_name, substitutes):
+        graph.setdefault(glyph_name, set()).update(substitutes)
+
+    if 'GSUB' not in font:
+        return graph
+    for lookup in font['GSUB'].table.LookupList.Lookup:
+        for subtable in lookup.SubTable:
+            lookup_type = lookup.LookupType
+            if lookup_type == 7:
+                lookup_type = subtable.ExtensionLookupType
+                subtable = subtable.ExtSubTable
+            if lookup_type == 1:
+                for glyph_name, substitute in subtable.mapping.items():
+                    add(glyph_name, [substitute])
+            elif lookup_type == 2:
+                for glyph_name, sequence in subtable.mapping.items():
+                    add(glyph_name, sequence)
+            elif lookup_type == 3:
+                for glyph_name, alternates in subtable.alternates.items():
+                    add(glyph_name, alternates)
+            elif lookup_type == 4:
+                for first_glyph_name, ligatures in subtable.ligatures.items():
+                    for ligature in ligatures:
+                        for glyph_name in [first_glyph_name] + ligature.Component:
+                            add(glyph_name, [ligature.LigGlyph])
+            elif lookup_type == 8:
+                for glyph_name, substitute in zip(subtable.Coverage.glyphs, subtable.Substitute):
+                    add(glyph_name, [substitute])
+    return graph
+
+
+def position_limits(font):
+    """Find the largest vertical offset GPOS can give a glyph that is not a mark, and the mark glyphs
+
+    The offset is None if glyphs that are not marks can be moved by any amount, as with cursive attachment.
+    """
+
+    offset = 0
+    marks = set()
+    if 'GDEF' in font and font['GDEF'].table.GlyphClassDef:
+        for glyph_name, glyph_class in font['GDEF'].table.GlyphClassDef.classDefs.items():
+            if glyph_class == 3:
+                marks.add(glyph_name)
+    if 'GPOS' not in font:
+        return offset, marks
+    for lookup in font['GPOS'].table.LookupList.Lookup:
+        lookup_offset = 0
+        for subtable in lookup.SubTable:
+            lookup_type = lookup.LookupType
+            if lookup_type == 9:
+                lookup_type = subtable.ExtensionLookupType
+                subtable = subtable.ExtSubTable
+            values = []
+            if lookup_type == 1:
+                values = [subtable.Value] if subtable.Format == 1 else subtable.Value
+            elif lookup_type == 2:
+                if subtable.Format == 1:
+                    for pair_set in subtable.PairSet:
+                        for pair_value_record in pair_set.PairValueRecord:
+                            values += [pair_value_record.Value1, pair_value_record.Value2]
+                else:
+                    for class1_record in subtable.Class1Record:
+                        for class2_record in class1_record.Class2Record:
+                            values += [class2_record.Value1, class2_record.Value2]
+            elif lookup_type == 3:
+                return None, marks
+            elif lookup_type in (4, 5):
+                marks.update(subtable.MarkCoverage.glyphs)
+            elif lookup_type == 6:
+                marks.update(subtable.Mark1Coverage.glyphs)
+            for value in values:
+                if value is not None:
+                    lookup_offset = max(lookup_offset, abs(getattr(value, 'YPlacement', 0)))
+        offset += lookup_offset
+    return offset, marks
 
 
 def report(extremas, records):
@@ -133,9 +845,129 @@ def report(extremas, records):
             break
 
 
+class Candidates:
+    """Texts with levels extreme enough to possibly occur among the records
+
+    Every distinct text occurs at least once, so a text less extreme than
+    the number of records most extreme distinct texts can not be a record.
+    Ties with the least extreme of those are kept as candidates,
+    but only as many as the number of records, since ties are broken by the first occurrence of a text.
+    The levels of texts that occur elsewhere can be given as extremes, so fewer texts are candidates.
+    """
+
+    def __init__(self, records, highest=False, extremes=()):
+        self.records = records
+        self.sign = -1 if highest else 1
+        # heap of the most extreme levels, least extreme first
+        self.heap = [-value for value in sorted(self.sign * level for level in extremes)[:max(records, 0)]]
+        heapq.heapify(self.heap)
+        self.candidates = dict()
+        # order of the first occurrence of each candidate
+        self.orders = dict()
+        self.added = 0
+        self.purge_size = records
+
+    def add(self, text, level, order=None):
+        """Add a text, unless its level is not extreme enough for it to be a record
+
+        The order of the first occurrence of the text is the order texts are added in, unless it is given.
+        """
+
+        if self.records <= 0:
+            return
+        value = self.sign * level
+        if len(self.heap) < self.records:
+            heapq.heappush(self.heap, -value)
+        elif value < -self.heap[0]:
+            heapq.heapreplace(self.heap, -value)
+        elif value > -self.heap[0]:
+            return
+        self.candidates[text] = level
+        if order is None:
+            order = self.added
+        self.added += 1
+        if text not in self.orders or order < self.orders[text]:
+            self.orders[text] = order
+        if len(self.candidates) > 2 * self.purge_size:
+            self.purge()
+
+    def reachable(self, level):
+        """Check if a level is extreme enough to be a candidate"""
+        if self.records <= 0:
+            return False
+        if len(self.heap) < self.records:
+            return True
+        return self.sign * level <= -self.heap[0]
+
+    def purge(self):
+        """Remove texts that are no longer extreme enough"""
+
+        if len(self.heap) == self.records:
+            threshold = -self.heap[0]
+            self.candidates = {text: level for text, level in self.candidates.items()
+                               if self.sign * level <= threshold}
+            # ties that occur after as many other ties as the number of records cannot be records
+            ties = [text for text, level in self.candidates.items() if self.sign * level == threshold]
+            ties.sort(key=self.orders.get)
+            for text in ties[self.records:]:
+                del self.candidates[text]
+            self.orders = {text: self.orders[text] for text in self.candidates}
+        self.purge_size = max(self.records, len(self.candidates))
+
+    def levels(self):
+        """Return a dictionary of the level of each candidate text"""
+        self.purge()
+        return self.candidates
+
+    def extremes(self):
+        """Return the most extreme levels, up to the number of records"""
+        return [-self.sign * value for value in self.heap]
+
+
+class ExtremaRecords:
+    """Keep the most extreme levels found, up to a number of records
+
+    Entries are kept in a heap with the least extreme entry first,
+    so it can be replaced when a more extreme level is found.
+    Ties are broken by order, with earlier entries kept first.
+    """
+
+    def __init__(self, records, highest=False):
+        self.records = records
+        self.sign = -1 if highest else 1
+        self.heap = []
+
+    def add(self, level, order, test_word, font_filename):
+        """Record a level, returning False if it is not extreme enough to be kept"""
+
+        key = (-self.sign * level, -order)
+        if len(self.heap) < self.records:
+            heapq.heappush(self.heap, (key, Extrema(test_word, level, font_filename)))
+            return True
+        if not self.heap or key <= self.heap[0][0]:
+            return False
+        heapq.heapreplace(self.heap, (key, Extrema(test_word, level, font_filename)))
+        return True
+
+    def update(self, other):
+        """Merge in the entries of other records"""
+
+        for key, extrema in other.heap:
+            if len(self.heap) < self.records:
+                heapq.heappush(self.heap, (key, extrema))
+            elif self.heap and key > self.heap[0][0]:
+                heapq.heapreplace(self.heap, (key, extrema))
+
+    def extremas(self):
+        """Return the extremas kept, most extreme first"""
+        return [extrema for key, extrema in sorted(self.heap, key=lambda entry: entry[0], reverse=True)]
+
+
 class Extrema:
     """Data about an extrema"""
 
+    __slots__ = ('test_word', 'level', 'font_filename')
+
     def __init__(self, test_word, level, font_filename):
         self.test_word = test_word
         self.level = level
@@ -148,7 +980,7 @@ class Extrema:
         return f'{self.test_word.text}\n{escape}\nat {self.level} from {self.test_word.text_filename}:{self.test_word.line_num}:{self.test_word.word_num} in {self.font_filename}'
 
 
-def show(lowest, highest, fonts):
+def show(lowest, highest, font_extremas, fonts, locations=None):
     data = []
 
     high_labels = [
@@ -166,13 +998,22 @@ def show(lowest, highest, fonts):
     other_labels = [
         'OS2TypoLineGap', 'HheaLineGap'
     ]
+    # compiled fonts have a column for each axis location
+    columns = []
+    for font_filename in fonts:
+        if os.path.splitext(font_filename)[1] == '.ufo':
+            columns.append((font_filename, None))
+        else:
+            for location in locations or [()]:
+                columns.append((font_filename, location))
+
     labels = high_labels + low_labels + other_labels
-    if len(fonts) > 1:
+    if len(columns) > 1:
         labels.insert(0, 'Field')
     data.append(labels)
 
     align = ['left']
-    for font_filename in fonts:
+    for font_filename, location in columns:
         root, ext = os.path.splitext(font_filename)
         if ext == '.ufo':
             font = fontparts.OpenFont(font_filename)
@@ -214,13 +1055,15 @@ def show(lowest, highest, fonts):
                 font['hhea'].lineGap
             ]
 
+        # compiled fonts show their own extrema, sources show the extrema of all fonts
+        font_lowest, font_highest = font_extremas.get((font_filename, location), (lowest, highest))
         if highest:
-            high_values.append(highest[0].level) 
+            high_values.append(font_highest[0].level if font_highest else '')
         if lowest:
-            low_values.append(lowest[0].level)
+            low_values.append(font_lowest[0].level if font_lowest else '')
         values = high_values + low_values + other_values
-        if len(fonts) > 1:
-            values.insert(0, root)
+        if len(columns) > 1:
+            values.insert(0, instance_name(root, location))
         align.append('right')
         data.append(values)
 
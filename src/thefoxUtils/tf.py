@@ -1,10 +1,20 @@
 #!/usr/bin/python3
 
 import argparse
+import concurrent.futures
+import fnmatch
+import itertools
+import json
+import mmap
 import os
+import re
+import shutil
+import stat
+import tempfile
 import unicodedata
 
 from thefoxUtils import version
+from thefoxUtils.cache import FileCache, add_cache_arguments
 
 # from palaso.teckit import engine
 
@@ -12,6 +22,18 @@ DOS = '\r\n'
 MAC = '\r'
 UNIX = '\n'
 
+# searches of the bytes of a file for report only runs
+MAC_BYTES = re.compile(rb'\r(?!\n)')
+UNIX_BYTES = re.compile(rb'(?<!\r)\n')
+TRAILING_WHITESPACE_BYTES = (b' \r', b' \n', b'\t\r', b'\t\n')
+NON_ASCII_BYTES = re.compile(rb'[\x80-\xff]')
+
+# number of characters to copy at a time
+CHUNK_SIZE = 1024 * 1024
+
+# number of files to keep reports on in the report cache
+REPORT_CACHE_SIZE = 100000
+
 
 def main():
     parser = argparse.ArgumentParser(description='Report on and optionally change text files')
@@ -27,10 +49,21 @@ def main():
                         dest='requested_nf', help='apply NFD normalization')
     parser.add_argument('-w', '--whitespace', action='store_true',
                         help='trim trailing whitespace')
-    parser.add_argument('file', help='files to process', nargs='+')
+    parser.add_argument('-j', '--jobs', help='number of processes to process files with',
+                        type=int, default=1)
+    parser.add_argument('-r', '--recursive', help='process the files in the directory and its subdirectories',
+                        action='append', default=[], dest='directories', metavar='DIR')
+    parser.add_argument('--include', help='only process files found with -r that match the glob',
+                        action='append', default=[], metavar='GLOB')
+    parser.add_argument('--exclude', help='skip files and directories found with -r that match the glob',
+                        action='append', default=[], metavar='GLOB')
+    add_cache_arguments(parser, 'tf', 'reuse the reports on files that have not changed since they were reported on')
+    parser.add_argument('file', help='files to process', nargs='*')
     parser.add_argument('--version', action='version',
                         version='%(prog)s ' + version)
     args = parser.parse_args()
+    if not args.file and not args.directories:
+        parser.error('the following arguments are required: file or --recursive')
 
     process_files(args)
 
@@ -43,26 +76,136 @@ def normalize(form, text):
     return unicodedata.normalize(form, text)
 
 
+def is_normalized(form, text):
+    """Return whether the text is in the normal form given by form, which is 'NFC', 'NFKC', 'NFD' or 'NFKD'.
+
+    ASCII text is in all of the normal forms, so it is not checked any further.
+    """
+    return text.isascii() or unicodedata.is_normalized(form, text)
+
+
 def process_files(args):
+    input_filenames = list(args.file)
+    for directory in args.directories:
+        input_filenames.extend(find_files(directory, args.include, args.exclude))
     max_filename_length = 0
-    for input_filename in args.file:
+    for input_filename in input_filenames:
         max_filename_length = max(len(input_filename), max_filename_length)
-    for input_filename in args.file:
+
+    # only reports are cached, files to be changed are always read
+    cache = None
+    if args.cache and not (args.requested_eol or args.requested_nf or args.whitespace):
+        cache = ReportCache(args.cache, args)
+    cached = dict()
+    if cache:
+        for input_filename in input_filenames:
+            reports = cache.read(input_filename)
+            if reports is not None:
+                cached[input_filename] = reports
+    uncached = [input_filename for input_filename in input_filenames if input_filename not in cached]
+
+    if args.jobs > 1:
+        all_reports = parallel_reports(args, uncached)
+    else:
+        all_reports = (process_file(args.requested_eol, args.requested_nf, args.whitespace, input_filename)
+                       for input_filename in uncached)
+    for input_filename in input_filenames:
+        if input_filename in cached:
+            reports = cached[input_filename]
+        else:
+            reports = next(all_reports)
+            if cache:
+                cache.write(input_filename, reports)
         filename = '{:{width}s}'.format(input_filename, width=max_filename_length)
-        reports = process_file(args.requested_eol, args.requested_nf, args.whitespace, input_filename)
         sep = ':'
         if reports != '':
             sep += ' '
         print(f'{filename}{sep}{reports}')
+    if cache:
+        cache.save()
+        cache.close()
+
+
+def find_files(directory, includes, excludes):
+    """Find the files in the directory and its subdirectories.
+
+    Files are found if they match any of the include globs (or there are none),
+    and neither they nor their directories match any of the exclude globs.
+    Globs are matched with both the name of the file or directory and its path relative to the directory.
+    """
+
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(name for name in dirs if not matches(directory, os.path.join(root, name), excludes))
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if matches(directory, path, excludes):
+                continue
+            if includes and not matches(directory, path, includes):
+                continue
+            yield path
+
+
+def matches(directory, path, globs):
+    """Does the path match any of the globs."""
+    name = os.path.basename(path)
+    relative = os.path.relpath(path, directory)
+    return any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(relative, pattern) for pattern in globs)
+
+
+class ReportCache(FileCache):
+    """Reports on files kept between runs, keyed by the options used to make the report"""
+
+    version = 3
+    table = 'reports'
+    size = REPORT_CACHE_SIZE
+
+    def __init__(self, cache_filename, args):
+        super().__init__(cache_filename, json.dumps([args.requested_eol, args.requested_nf, args.whitespace]))
+
+
+def parallel_reports(args, input_filenames):
+    """Process the files with a pool of processes, returning the reports in the order the files were given.
+
+    All the names given for the same file are processed in turn by one process,
+    so a file is never converted by two processes at once.
+    """
+
+    paths = [os.path.realpath(input_filename) for input_filename in input_filenames]
+    groups = dict()
+    for input_filename, path in zip(input_filenames, paths):
+        groups.setdefault(path, []).append(input_filename)
+    chunksize = max(1, len(groups) // (args.jobs * 4))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        results = executor.map(process_group, itertools.repeat(args.requested_eol), itertools.repeat(args.requested_nf),
+                               itertools.repeat(args.whitespace), groups.values(), chunksize=chunksize)
+        # groups are in the order of their first file, as are the results
+        group_reports = dict()
+        for path in paths:
+            if path not in group_reports:
+                group_reports[path] = iter(next(results))
+            yield next(group_reports[path])
+
+
+def process_group(requested_eol, normalization, whitespace, input_filenames):
+    """Process each of the names of the same file in turn."""
+    return [process_file(requested_eol, normalization, whitespace, input_filename)
+            for input_filename in input_filenames]
 
 
 def process_file(requested_eol, normalization, whitespace, input_filename):
+    # pipes, devices and files such as those in /proc, which have no size, can only be read as a stream
+    if not (requested_eol or whitespace or normalization):
+        file_stat = os.stat(input_filename)
+        if stat.S_ISREG(file_stat.st_mode) and file_stat.st_size > 0:
+            return scan_file(input_filename)
+
     input_file = open(input_filename, 'r', encoding='utf-8', newline='')
 
-    if requested_eol or whitespace or normalization:
-        # TODO use module tempfile
-        temp_filename = input_filename + '.temp'
-        temp = open(temp_filename, 'w', encoding='utf-8')
+    # the temp file is only created once a line needs to change
+    temp = None
+    temp_filename = None
+    position = 0
 
     # run through all the lines in the file
     newlines = set()
@@ -71,53 +214,147 @@ def process_file(requested_eol, normalization, whitespace, input_filename):
     blank_line = False
     nfc = True
     nfd = True
-    for line in input_file:
-        # find out what type of newline there is
-        if line.endswith(DOS):
-            current_eol = DOS
-            label = 'dos'
-        elif line.endswith(MAC):
-            current_eol = MAC
-            label = 'mac'
-        elif line.endswith(UNIX):
-            current_eol = UNIX
-            label = 'unix'
-        else:
-            current_eol = ''
-            label = 'missing'
-            trailing_eol = False
-        newlines.add(label)
-        all_text = line.rstrip(current_eol)
-
-        # remove trailing whitespace from the line
-        visible_text = all_text.rstrip(' \t')
-        if visible_text == '':
-            blank_line = True
-        else:
-            blank_line = False
-        if all_text != visible_text:
-            trailing_whitespace = True
-        if whitespace:
-            all_text = visible_text
-
-        # normalize text
-        if all_text != normalize('NFC', all_text):
-            nfc = False
-        if all_text != normalize('NFD', all_text):
-            nfd = False
-        if normalization:
-            all_text = normalize(normalization, all_text)
-
-        # change eol in the file
-        if requested_eol:
-            current_eol = requested_eol
-        output_line = all_text + current_eol
-
-        if requested_eol or whitespace or normalization:
+    try:
+        for line in input_file:
+            # find out what type of newline there is
+            if line.endswith(DOS):
+                current_eol = DOS
+                label = 'dos'
+            elif line.endswith(MAC):
+                current_eol = MAC
+                label = 'mac'
+            elif line.endswith(UNIX):
+                current_eol = UNIX
+                label = 'unix'
+            else:
+                current_eol = ''
+                label = 'missing'
+                trailing_eol = False
+            newlines.add(label)
+            all_text = line.rstrip(current_eol)
+
+            # remove trailing whitespace from the line
+            visible_text = all_text.rstrip(' \t')
+            if visible_text == '':
+                blank_line = True
+            else:
+                blank_line = False
+            if all_text != visible_text:
+                trailing_whitespace = True
+            if whitespace:
+                all_text = visible_text
+
+            # normalize text, once a form has failed there is no need to check it again
+            if nfc and not is_normalized('NFC', all_text):
+                nfc = False
+            if nfd and not is_normalized('NFD', all_text):
+                nfd = False
+            if normalization and not all_text.isascii():
+                # normalize returns text already in the form without changing it
+                all_text = normalize(normalization, all_text)
+
+            # change eol in the file
+            if requested_eol:
+                current_eol = requested_eol
+            output_line = all_text + current_eol
+
             # write line and new eol and any trimmed whitespace to a temp file
-            temp.write(output_line)
+            if temp is None and output_line != line:
+                (temp, temp_filename) = start_temp(input_filename, position)
+            if temp:
+                temp.write(output_line)
+            position += len(line)
+    except BaseException:
+        input_file.close()
+        if temp:
+            temp.close()
+            os.remove(temp_filename)
+        raise
+
+    # cleanup
+    input_file.close()
+    if temp:
+        temp.close()
+
+        # keep the permissions and times of the original file
+        file_stat = os.stat(input_filename)
+        shutil.copymode(input_filename, temp_filename)
+        os.utime(temp_filename, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns))
+        os.replace(temp_filename, input_filename)
+
+    # output
+    return report(newlines, trailing_eol, nfc, nfd, trailing_whitespace, blank_line)
+
+
+def start_temp(input_filename, length):
+    """Create a temp file next to the input file, starting with the first length characters of the input file."""
+
+    directory = os.path.dirname(os.path.abspath(input_filename))
+    prefix = '.' + os.path.basename(input_filename) + '.'
+    (temp_fd, temp_filename) = tempfile.mkstemp(dir=directory, prefix=prefix, suffix='.temp')
+    temp = open(temp_fd, 'w', encoding='utf-8', newline='')
+    try:
+        with open(input_filename, 'r', encoding='utf-8', newline='') as input_file:
+            while length > 0:
+                text = input_file.read(min(length, CHUNK_SIZE))
+                temp.write(text)
+                length -= len(text)
+    except BaseException:
+        temp.close()
+        os.remove(temp_filename)
+        raise
+    return temp, temp_filename
+
+
+def scan_file(input_filename):
+    """Report on the regular file without changing it, searching the bytes of the file instead of decoding each line.
+
+    The file is only decoded if it is not ASCII, to check normalization.
+    CR and LF are never part of other characters in UTF-8, and do not interact with normalization,
+    so the whole file can be checked at once.
+    """
+
+    with open(input_filename, 'rb') as input_file:
+        if os.fstat(input_file.fileno()).st_size == 0:
+            return report(set(), True, True, True, False, False)
+        with mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            newlines = set()
+            if data.find(b'\r\n') != -1:
+                newlines.add('dos')
+            if MAC_BYTES.search(data):
+                newlines.add('mac')
+            if UNIX_BYTES.search(data):
+                newlines.add('unix')
+
+            # the last line
+            end = len(data)
+            tail = data[-2:]
+            if tail == b'\r\n':
+                end -= 2
+            elif tail[-1:] in (b'\r', b'\n'):
+                end -= 1
+            trailing_eol = end < len(data)
+            start = max(data.rfind(b'\r', 0, end), data.rfind(b'\n', 0, end)) + 1
+            blank_line = data[start:end].strip(b' \t') == b''
+
+            trailing_whitespace = tail[-1:] in (b' ', b'\t')
+            for whitespace_eol in TRAILING_WHITESPACE_BYTES:
+                if trailing_whitespace:
+                    break
+                trailing_whitespace = data.find(whitespace_eol) != -1
+
+            nfc = True
+            nfd = True
+            if NON_ASCII_BYTES.search(data):
+                text = str(data, 'utf-8')
+                nfc = unicodedata.is_normalized('NFC', text)
+                nfd = unicodedata.is_normalized('NFD', text)
+    return report(newlines, trailing_eol, nfc, nfd, trailing_whitespace, blank_line)
+
+
+def report(newlines, trailing_eol, nfc, nfd, trailing_whitespace, blank_line):
+    """Condense what was found in the file into a report."""
 
-    # report on what was found in the file
     reports = list()
 
     # newlines
@@ -169,17 +406,6 @@ def process_file(requested_eol, normalization, whitespace, input_filename):
         ws_report = 'ws: ' + ' '.join(ws)
         reports.append(ws_report)
 
-    # cleanup
-    input_file.close()
-    if requested_eol or whitespace or normalization:
-        temp.close()
-
-        cmd = "touch -r \"%s\" \"%s\"" % (input_filename, temp_filename)
-        os.system(cmd)
-        os.remove(input_filename)
-        os.rename(temp_filename, input_filename)
-
-    # output
     return ' '.join(reports)
 
 
@@ -1,19 +1,62 @@
 #!/usr/bin/python3
 
 import argparse
-import lzma
+import array
+import bisect
+import codecs
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import io
+import json
+import mmap
 import os
 import os.path
-import pickle
+import re
+import socket
+import socketserver
+import struct
+import sys
+import tempfile
 
 from thefoxUtils import version
+from thefoxUtils.cache import FileCache, add_cache_arguments
+
+# the UCD cache starts with this, followed by the number of names, ranges, words and postings,
+# and the size of the description of the sources of the cache
+UCD_MAGIC = b'UNIDUMP\x04'
+UCD_HEADER = struct.Struct('<IIIII')
+
+# words in names that can be searched for
+WORD = re.compile(r'\w+')
+
+# number of characters to read at a time when the whole file is processed
+CHUNK_SIZE = 1024 * 1024
+
+# number of formatted characters to remember
+FORMAT_CACHE_SIZE = 4096
+
+# the line index of a file is stored next to it, and records where every LINE_INDEX_INTERVAL lines start
+LINE_INDEX_SUFFIX = '.unidump-lines'
+LINE_INDEX_INTERVAL = 1000
+LINE_INDEX_MAGIC = b'UNILINE1'
+LINE_INDEX_HEADER = struct.Struct('<8sQQQQ')
+
+# number of files to keep counts for in the count cache
+COUNT_CACHE_SIZE = 10000
 
 
 def cmdline():
     parser = argparse.ArgumentParser(description='Show USV values of characters in a file')
     parser.add_argument('--count', help='count characters instead of just listing them',
                         action='store_true')
+    parser.add_argument('-j', '--jobs', help='number of processes to count characters with',
+                        type=int, default=1)
+    add_cache_arguments(parser, 'unidump', 'reuse the counts of files that have not changed since they were counted')
     parser.add_argument('--quote', help='quote a Unicode character')
+    parser.add_argument('--find', help='list the characters with all these words in their name')
     parser.add_argument('--encoding', help='file encoding',
                         default='utf-8')
     parser.add_argument('--errors', help='error mode for encoding',
@@ -32,9 +75,16 @@ def cmdline():
                         type=int, default=1)
     parser.add_argument('--eol', help='read only to the end of the line',
                         action='store_true')
+    parser.add_argument('--index', help='keep an index of lines next to the file to quickly find the --line',
+                        action='store_true')
     parser.add_argument('--ucd', help='update the Unicode character database',
                         action='store_true')
-    parser.add_argument('file', help='file to process', nargs='+')
+    parser.add_argument('--unicode-version', help='version of Unicode the files for --ucd are from')
+    parser.add_argument('--serve', help='keep the Unicode character database loaded and answer requests from clients',
+                        action='store_true')
+    parser.add_argument('--client', help='have a running server do the work, if there is one',
+                        action='store_true')
+    parser.add_argument('file', help='file to process', nargs='*')
     parser.add_argument('--version', action='version',
                         version='%(prog)s ' + version)
     return parser
@@ -43,19 +93,38 @@ def cmdline():
 def main():
     parser = cmdline()
     args = parser.parse_args()
-    ucdCacheFilename = os.path.join(os.environ["HOME"], ".unidump", "ucd.pickle.xz")
+    if not args.file and not args.quote and not args.find and not args.serve:
+        parser.error('the following arguments are required: file')
+    ucdCacheFilename = os.path.join(os.environ["HOME"], ".unidump", "ucd.bin")
+    socketFilename = os.path.join(os.environ["HOME"], ".unidump", "socket")
 
     if args.ucd:
-        update_ucd(args.file, ucdCacheFilename)
+        update_ucd(args.file, ucdCacheFilename, args.unicode_version)
+    elif args.serve:
+        serve(ucdCacheFilename, socketFilename)
+    elif args.client and client(socketFilename, sys.argv[1:]):
+        pass
     else:
         ucd = read_ucd(ucdCacheFilename)
         options = Options(args, ucd)
-        if args.quote:
-            quotechar(options)
-        elif args.count:
-            countfiles(options)
-        else:
-            dumpfiles(options)
+        run(options)
+
+
+def run(options):
+    """Show or count the characters requested in the options."""
+
+    args = options.args
+    if args.quote:
+        quotechar(options)
+    elif args.find:
+        findchars(options)
+    elif args.count:
+        countfiles(options)
+    else:
+        dumpfiles(options)
+    if args.debug:
+        cache_info = options.format_cache.cache_info()
+        print(f'DEBUG: format cache {cache_info.hits} hits {cache_info.misses} misses')
 
 
 class Options(object):
@@ -63,42 +132,442 @@ class Options(object):
     def __init__(self, args, ucd):
         self.args = args
         self.ucd = ucd
-
-
-def update_ucd(unicodeDataFilenames, ucdCacheFilename):
-    """Update the Unicode Character Database (UCD) cache."""
-
-    ucd = dict()
+        self.format_cache = functools.lru_cache(maxsize=FORMAT_CACHE_SIZE)(self.format_uncached)
+
+    def format_uncached(self, cc, *settings):
+        """Format the character, the settings are only used as part of the key for the cache."""
+        return format(self, cc)
+
+
+def serve(ucdCacheFilename, socketFilename):
+    """Answer requests from clients until interrupted."""
+
+    if not hasattr(socket, 'AF_UNIX'):
+        sys.exit('unidump: --serve needs Unix domain sockets, which are not available on this system')
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(socketFilename)
+    with make_server(read_ucd(ucdCacheFilename), socketFilename) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(socketFilename)
+
+
+def make_server(ucd, socketFilename):
+    """Create a server that answers requests on a Unix domain socket.
+
+    A request is one line of JSON with the working directory and the command line arguments of the client.
+    The response is a line with OK followed by the output, or a line with ERROR and a message.
+    """
+
+    server = socketserver.UnixStreamServer(socketFilename, RequestHandler)
+    server.options = Options(None, ucd)
+    return server
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        options = self.server.options
+        try:
+            # the cache might have been rebuilt, or its sources changed, since the last request
+            ucd = reread_ucd(options.ucd)
+            if ucd is not options.ucd:
+                options.ucd = ucd
+                options.format_cache.cache_clear()
+            request = json.loads(self.rfile.readline())
+            parser = cmdline()
+            try:
+                options.args = parser.parse_args(request['argv'])
+            except SystemExit:
+                raise ValueError('invalid arguments')
+            options.args.file = [os.path.join(request['cwd'], filename) for filename in options.args.file]
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                run(options)
+            response = 'OK\n' + output.getvalue()
+        except Exception as e:
+            response = f'ERROR {e}\n'
+        self.wfile.write(response.encode('utf-8'))
+
+
+def client(socketFilename, argv):
+    """Have the server answer the request, returns False if no server is running."""
+
+    if not hasattr(socket, 'AF_UNIX'):
+        return False
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.connect(socketFilename)
+            request = json.dumps({'cwd': os.getcwd(), 'argv': argv}) + '\n'
+            connection.sendall(request.encode('utf-8'))
+            with connection.makefile('r', encoding='utf-8', newline='') as response:
+                status = response.readline()
+                output = response.read()
+    except (FileNotFoundError, ConnectionRefusedError):
+        return False
+    if status.startswith('ERROR'):
+        sys.exit(f'unidump: {status[len("ERROR "):].rstrip()}')
+    sys.stdout.write(output)
+    return True
+
+
+def update_ucd(unicodeDataFilenames, ucdCacheFilename, unicode_version=None):
+    """Update the Unicode Character Database (UCD) cache.
+
+    Each file is a layer, with names from later files replacing names from earlier ones.
+    Layers are kept (in the layers directory next to the cache) by the hash of the file contents,
+    so only new or changed files are read again.
+    """
+
+    layers_dir = os.path.join(os.path.dirname(os.path.abspath(ucdCacheFilename)), 'layers')
+    os.makedirs(layers_dir, exist_ok=True)
+    names = dict()
+    ranges = list()
+    sources = list()
     for unicodeDataFilename in unicodeDataFilenames:
-        with open(unicodeDataFilename) as unicodeDataFile:
-            for line in unicodeDataFile:
-                fields = line.split(';')
-                usv = fields[0]
-                name = fields[1]
-                alt_name = fields[10]
-                if name == '<control>':
-                    name = f'({alt_name})'
-                ucd[usv] = name
-                if name.startswith('<') and name.endswith('First>'):
-                    start = int(usv, 16)
-                    name_pattern = name.strip('<>')
-                    name_pattern = name_pattern.split(',')[0]
-                if name.startswith('<') and name.endswith('Last>'):
-                    stop = int(usv, 16)
-                    for codepoint in range(start, stop + 1):
-                        usv = codepoint2usv(codepoint)
-                        name = f'{name_pattern}-{usv}'
-                        ucd[usv] = name
-    with lzma.open(ucdCacheFilename, 'wb') as ucdCacheFile:
-        pickle.dump(ucd, ucdCacheFile)
-
-
-def read_ucd(ucdCacheFile):
-    """Read data from the Unicode Character Database (UCD) cache."""
-
-    with lzma.open(ucdCacheFile, 'rb') as ucdCache:
-        ucd = pickle.load(ucdCache)
-    return ucd
+        file_stat = os.stat(unicodeDataFilename)
+        with open(unicodeDataFilename, 'rb') as unicodeDataFile:
+            digest = hashlib.sha256(unicodeDataFile.read()).hexdigest()
+        sources.append({'path': os.path.abspath(unicodeDataFilename), 'sha256': digest,
+                        'size': file_stat.st_size, 'mtime_ns': file_stat.st_mtime_ns})
+
+        layer_filename = os.path.join(layers_dir, digest + '.json')
+        try:
+            with open(layer_filename) as layer_file:
+                layer = json.load(layer_file)
+        except (OSError, ValueError):
+            (layer_names, layer_ranges) = read_unicode_data(unicodeDataFilename)
+            layer = {'names': sorted(layer_names.items()), 'ranges': layer_ranges}
+            with open(layer_filename, 'w') as layer_file:
+                json.dump(layer, layer_file)
+
+        for (start, stop, name_pattern) in layer['ranges']:
+            add_range(names, ranges, start, stop, name_pattern)
+        names.update(layer['names'])
+
+    # remove layers of files that are no longer used
+    digests = {source['sha256'] for source in sources}
+    for layer_filename in os.listdir(layers_dir):
+        if layer_filename.endswith('.json') and layer_filename[:-len('.json')] not in digests:
+            os.remove(os.path.join(layers_dir, layer_filename))
+
+    write_ucd(names, ranges, ucdCacheFilename, {'unicode_version': unicode_version, 'sources': sources})
+
+
+def read_unicode_data(unicodeDataFilename):
+    """Read the names and ranges of names in a file in the format of UnicodeData.txt."""
+
+    names = dict()
+    ranges = list()
+    with open(unicodeDataFilename) as unicodeDataFile:
+        for line in unicodeDataFile:
+            fields = line.split(';')
+            codepoint = int(fields[0], 16)
+            name = fields[1]
+            alt_name = fields[10]
+            if name == '<control>':
+                name = f'({alt_name})'
+            if name.startswith('<') and name.endswith('First>'):
+                start = codepoint
+                name_pattern = name.strip('<>')
+                name_pattern = name_pattern.split(',')[0]
+            elif name.startswith('<') and name.endswith('Last>'):
+                add_range(names, ranges, start, codepoint, name_pattern)
+            else:
+                names[codepoint] = name
+    return names, ranges
+
+
+def add_range(names, ranges, start, stop, name_pattern):
+    """Add a range of characters named by name_pattern, replacing earlier names in the range."""
+
+    for codepoint in [codepoint for codepoint in names if start <= codepoint <= stop]:
+        del names[codepoint]
+    kept = list()
+    for (first, last, pattern) in ranges:
+        if first < start:
+            kept.append((first, min(last, start - 1), pattern))
+        if last > stop:
+            kept.append((max(first, stop + 1), last, pattern))
+    kept.append((start, stop, name_pattern))
+    ranges[:] = sorted(kept)
+
+
+def write_ucd(names, ranges, ucdCacheFilename, sources=None):
+    """Write the UCD cache as sorted indexes of codepoints, ranges and words in names, followed by the strings.
+
+    Each word has a list of postings, which are indexes of the names (or the count of names plus the index
+    of the range) that contain the word. The description of the sources is stored as JSON after the header.
+    """
+
+    codepoints = array.array('I', sorted(names))
+    starts = array.array('I', [start for (start, stop, name_pattern) in ranges])
+    stops = array.array('I', [stop for (start, stop, name_pattern) in ranges])
+    offsets = array.array('I')
+    patterns = array.array('I')
+    blob = bytearray()
+    for codepoint in codepoints:
+        offsets.append(len(blob))
+        blob += names[codepoint].encode('utf-8')
+    offsets.append(len(blob))
+    for (start, stop, name_pattern) in ranges:
+        patterns.append(len(blob))
+        blob += name_pattern.encode('utf-8')
+    patterns.append(len(blob))
+
+    postings = collections.defaultdict(list)
+    name_patterns = [names[codepoint] for codepoint in codepoints]
+    name_patterns.extend(name_pattern for (start, stop, name_pattern) in ranges)
+    for posting, name in enumerate(name_patterns):
+        for word in dict.fromkeys(name_words(name)):
+            postings[word].append(posting)
+    words = array.array('I')
+    word_postings = array.array('I', [0])
+    all_postings = array.array('I')
+    for word in sorted(postings):
+        words.append(len(blob))
+        blob += word.encode('utf-8')
+        all_postings.extend(postings[word])
+        word_postings.append(len(all_postings))
+    words.append(len(blob))
+
+    tables = (codepoints, offsets, starts, stops, patterns, words, word_postings, all_postings)
+    description = describe_sources(sources)
+    header = UCD_MAGIC + UCD_HEADER.pack(len(codepoints), len(starts), len(postings), len(all_postings),
+                                         len(description))
+    for table in tables:
+        if sys.byteorder == 'big':
+            table.byteswap()
+    replace_file(ucdCacheFilename, [header, description] + [table.tobytes() for table in tables] + [blob])
+
+
+def describe_sources(sources):
+    """Describe the sources of the UCD cache as JSON, padded to keep the tables after it aligned."""
+    description = json.dumps(sources or {}).encode('utf-8')
+    return description + b' ' * (-len(description) % 4)
+
+
+def replace_file(filename, chunks):
+    """Write the file through a temp file, since a server, or another unidump, might have the previous file open."""
+
+    (fd, temp_filename) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)))
+    try:
+        with open(fd, 'wb') as temp_file:
+            for chunk in chunks:
+                temp_file.write(chunk)
+        # mkstemp only lets the owner read the file, give it the permissions of any other new file
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp_filename, 0o666 & ~umask)
+        os.replace(temp_filename, filename)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_filename)
+        raise
+
+
+def read_ucd(ucdCacheFilename):
+    """Read data from the Unicode Character Database (UCD) cache, updating it if its sources have changed."""
+    return check_ucd(UCD(ucdCacheFilename))
+
+
+def reread_ucd(ucd):
+    """Read the UCD cache again if it has been replaced, or update it if its sources have changed."""
+
+    file_stat = os.stat(ucd.filename)
+    if (file_stat.st_dev, file_stat.st_ino) != ucd.inode:
+        new_ucd = read_ucd(ucd.filename)
+        ucd.close()
+        return new_ucd
+    return check_ucd(ucd)
+
+
+def check_ucd(ucd):
+    """Return the UCD, or the UCD updated if its sources have changed.
+
+    A missing source is reported once, and then recorded as missing in the cache.
+    The cache cannot be updated while a source is missing.
+    Sources with new times but the same contents have their times recorded, so they are not read again on each run.
+    """
+
+    sources = ucd.sources.get('sources', [])
+    (changed, touched, missing) = ucd.check_sources()
+    recorded_missing = {source['path'] for source in sources if source.get('missing')}
+    new_missing = [path for path in missing if path not in recorded_missing]
+    for path in new_missing:
+        print(f'unidump: {path} used for the UCD cache is missing, names might be out of date', file=sys.stderr)
+    if changed and not missing:
+        # keep using the cache as it is if it cannot be updated, such as when it belongs to someone else
+        try:
+            update_ucd([source['path'] for source in sources], ucd.filename, ucd.sources.get('unicode_version'))
+            new_ucd = UCD(ucd.filename)
+        except OSError as e:
+            print(f'unidump: cannot update the UCD cache {ucd.filename}, names might be out of date: {e}',
+                  file=sys.stderr)
+            return ucd
+        ucd.close()
+        return new_ucd
+    if not (touched or new_missing):
+        return ucd
+
+    recorded = list()
+    for source in sources:
+        source = dict(source)
+        if source['path'] in touched:
+            file_stat = touched[source['path']]
+            source.update(size=file_stat.st_size, mtime_ns=file_stat.st_mtime_ns)
+            source.pop('missing', None)
+        elif source['path'] in missing:
+            source['missing'] = True
+        recorded.append(source)
+    description = describe_sources(dict(ucd.sources, sources=recorded))
+    header = UCD_MAGIC + UCD_HEADER.pack(*ucd.header[:-1], len(description))
+    # a file cannot be replaced while it is mapped on some systems
+    tables = ucd.cache[ucd.tables_start:]
+    ucd.close()
+    try:
+        replace_file(ucd.filename, [header, description, tables])
+    except OSError:
+        # the cache might belong to someone else, the sources will be checked again next time
+        pass
+    return UCD(ucd.filename)
+
+
+class UCD(object):
+    """Names from the UCD cache, looked up as needed in the memory-mapped cache file."""
+
+    def __init__(self, ucdCacheFilename):
+        self.filename = ucdCacheFilename
+        with open(ucdCacheFilename, 'rb') as ucdCacheFile:
+            file_stat = os.fstat(ucdCacheFile.fileno())
+            self.inode = (file_stat.st_dev, file_stat.st_ino)
+            self.cache = mmap.mmap(ucdCacheFile.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.cache[:len(UCD_MAGIC)] != UCD_MAGIC:
+            self.cache.close()
+            raise ValueError(f'{ucdCacheFilename} is not a UCD cache, rerun unidump --ucd')
+        self.header = UCD_HEADER.unpack_from(self.cache, len(UCD_MAGIC))
+        (count, range_count, word_count, posting_count, description_size) = self.header
+        self.view = memoryview(self.cache)
+        position = len(UCD_MAGIC) + UCD_HEADER.size
+        self.sources = json.loads(self.cache[position:position + description_size])
+        position += description_size
+        self.tables_start = position
+        self.tables = list()
+        for length in (count, count + 1, range_count, range_count, range_count + 1,
+                       word_count + 1, word_count + 1, posting_count):
+            self.tables.append(uint32s(self.view[position:position + 4 * length]))
+            position += 4 * length
+        (self.codepoints, self.offsets, self.starts, self.stops, self.patterns,
+         self.words, self.word_postings, self.postings) = self.tables
+        self.blob_start = position
+
+    def get(self, codepoint, default=None):
+        """Find the name of the character with the given codepoint."""
+        index = bisect.bisect_left(self.codepoints, codepoint)
+        if index < len(self.codepoints) and self.codepoints[index] == codepoint:
+            return self.text(self.offsets, index)
+        index = bisect.bisect_right(self.starts, codepoint) - 1
+        if index >= 0 and codepoint <= self.stops[index]:
+            name_pattern = self.text(self.patterns, index)
+            return f'{name_pattern}-{codepoint2usv(codepoint)}'
+        return default
+
+    def text(self, offsets, index):
+        """Decode a string from the blob at the end of the cache."""
+        start = self.blob_start + offsets[index]
+        stop = self.blob_start + offsets[index + 1]
+        return self.cache[start:stop].decode('utf-8')
+
+    def check_sources(self):
+        """Check the files the cache was made from.
+
+        Returns a list of the files that have changed, a dictionary of the files with the same contents
+        but a new size or time (or that were recorded as missing) and their os.stat results,
+        and a list of the missing files.
+        """
+
+        changed = list()
+        touched = dict()
+        missing = list()
+        for source in self.sources.get('sources', []):
+            path = source['path']
+            try:
+                file_stat = os.stat(path)
+            except OSError:
+                missing.append(path)
+                continue
+            unchanged = file_stat.st_size == source['size'] and file_stat.st_mtime_ns == source['mtime_ns']
+            if unchanged and not source.get('missing'):
+                continue
+            try:
+                with open(path, 'rb') as source_file:
+                    digest = hashlib.sha256(source_file.read()).hexdigest()
+            except OSError:
+                digest = None
+            if digest == source['sha256']:
+                touched[path] = file_stat
+            else:
+                changed.append(path)
+        return changed, touched, missing
+
+    def find(self, words):
+        """Find the codepoints of the characters with all of the words in their name."""
+
+        found = None
+        for word in dict.fromkeys(name_words(words)):
+            postings = set(self.word_postings_of(word))
+            found = postings if found is None else found & postings
+        codepoints = list()
+        for posting in sorted(found or ()):
+            if posting < len(self.codepoints):
+                codepoints.append(self.codepoints[posting])
+                continue
+            # characters with their own name are not named by the range they are in
+            index = posting - len(self.codepoints)
+            start = self.starts[index]
+            stop = self.stops[index]
+            first = bisect.bisect_left(self.codepoints, start)
+            last = bisect.bisect_right(self.codepoints, stop)
+            named = set(self.codepoints[first:last])
+            codepoints.extend(codepoint for codepoint in range(start, stop + 1) if codepoint not in named)
+        return sorted(codepoints)
+
+    def word_postings_of(self, word):
+        """Find the postings of the word."""
+        low = 0
+        high = len(self.words) - 1
+        while low < high:
+            middle = (low + high) // 2
+            if self.text(self.words, middle) < word:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.words) - 1 and self.text(self.words, low) == word:
+            return self.postings[self.word_postings[low]:self.word_postings[low + 1]]
+        return ()
+
+    def close(self):
+        for view in self.tables + [self.view]:
+            if isinstance(view, memoryview):
+                view.release()
+        self.cache.close()
+
+
+def name_words(name):
+    """Split a name, or words to search for, into the words used in the word index."""
+    return WORD.findall(name.upper())
+
+
+def uint32s(view):
+    """Read little-endian unsigned 32-bit integers, without copying them when possible."""
+    if sys.byteorder == 'little':
+        return view.cast('I')
+    values = array.array('I', view)
+    values.byteswap()
+    return values
 
 
 def quotechar(options):
@@ -108,12 +577,26 @@ def quotechar(options):
     print(format(options, cc))
 
 
+def findchars(options):
+    """Show Unicode values for the characters with the requested words in their names."""
+
+    for codepoint in options.ucd.find(options.args.find):
+        print(format(options, chr(codepoint)))
+
+
 def dumpfiles(options):
     """Show Unicode values for the characters in the files."""
 
     for inputFilename in options.args.file:
-        for display in dumpfile(options, inputFilename):
-            print(formatoutput(options, display), end='')
+        if whole_file(options):
+            for chunk in readchunks(options, inputFilename):
+                displays = dict()
+                for cc in set(chunk):
+                    displays[cc] = formatoutput(options, formatted(options, cc))
+                sys.stdout.write(''.join(map(displays.__getitem__, chunk)))
+        else:
+            for display in dumpfile(options, inputFilename):
+                sys.stdout.write(formatoutput(options, display))
 
 
 def formatoutput(options, display):
@@ -131,26 +614,58 @@ def dumpfile(options, input_filename):
     """Show Unicode values for the characters in the file."""
 
     for cc in readfile(options, input_filename):
-        display = format(options, cc)
+        display = formatted(options, cc)
         yield display
 
 
 def countfiles(options):
     """Count characters in the files"""
 
-    count = dict()
-    for input_filename in options.args.file:
-        countfile(options, count, input_filename)
+    args = options.args
+    cache = CountCache(args.cache, args) if args.cache else None
+    file_counts = dict()
+    if cache:
+        for input_filename in args.file:
+            file_count = cache.read(input_filename)
+            if file_count is not None:
+                file_counts[input_filename] = file_count
+    uncounted = [input_filename for input_filename in dict.fromkeys(args.file) if input_filename not in file_counts]
+
+    if args.jobs > 1 and whole_file(options):
+        file_counts.update(countfiles_parallel(options, uncounted))
+    else:
+        for input_filename in uncounted:
+            file_counts[input_filename] = dict()
+            countfile(options, file_counts[input_filename], input_filename)
+    if cache:
+        for input_filename in uncounted:
+            cache.write(input_filename, file_counts[input_filename])
+        cache.save()
+        cache.close()
 
+    count = dict()
+    for input_filename in args.file:
+        merge_counts(count, file_counts[input_filename])
     characters = sorted(count.keys())
     for cc in characters:
-        display = "%7d %s" % (count[cc], format(options, cc))
+        display = "%7d %s" % (count[cc], formatted(options, cc))
         print(display)
 
 
+def merge_counts(count, other_count):
+    """Add the counts of characters in other_count to count."""
+    for cc, other in other_count.items():
+        count[cc] = count.get(cc, 0) + other
+
+
 def countfile(options, count, input_filename):
     """Count characters in the file"""
 
+    if whole_file(options):
+        for chunk in readchunks(options, input_filename):
+            for cc, chunk_count in collections.Counter(chunk).items():
+                count[cc] = count.get(cc, 0) + chunk_count
+        return
     for cc in readfile(options, input_filename):
         if cc in count:
             count[cc] += 1
@@ -158,11 +673,110 @@ def countfile(options, count, input_filename):
             count[cc] = 1
 
 
+def whole_file(options):
+    """Is the whole file to be read, so it can be processed in chunks instead of a character at a time."""
+    args = options.args
+    return args.line == 1 and args.column == 1 and not args.eol and not args.debug
+
+
+def readchunks(options, input_filename):
+    """Return the file in large chunks of characters."""
+
+    with open(input_filename, 'r', encoding=options.args.encoding, errors=options.args.errors, newline='') as input_file:
+        while True:
+            chunk = input_file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def countfiles_parallel(options, input_filenames):
+    """Count characters in each file, with large UTF-8 files split into pieces, using a pool of processes."""
+
+    args = options.args
+    utf8 = codecs.lookup(args.encoding).name == 'utf-8'
+    file_counts = {input_filename: dict() for input_filename in input_filenames}
+    ranges = list()
+    for input_filename in input_filenames:
+        pieces = 1
+        if utf8:
+            pieces = max(1, min(args.jobs, os.path.getsize(input_filename) // CHUNK_SIZE))
+        for start, stop in byte_ranges(input_filename, pieces):
+            ranges.append((input_filename, start, stop))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(countrange, args.encoding, args.errors, *byte_range): byte_range[0]
+                   for byte_range in ranges}
+        for future in concurrent.futures.as_completed(futures):
+            merge_counts(file_counts[futures[future]], future.result())
+    return file_counts
+
+
+def byte_ranges(input_filename, pieces):
+    """Split the file into byte ranges that start on UTF-8 character boundaries."""
+
+    size = os.path.getsize(input_filename)
+    boundaries = [0]
+    with open(input_filename, 'rb') as input_file:
+        for piece in range(1, pieces):
+            boundary = max(size * piece // pieces, boundaries[-1])
+            input_file.seek(boundary)
+            while True:
+                octet = input_file.read(1)
+                if not octet or octet[0] & 0xC0 != 0x80:
+                    break
+                boundary += 1
+            boundaries.append(boundary)
+    boundaries.append(size)
+    return [(start, stop) for start, stop in zip(boundaries, boundaries[1:]) if start < stop or size == 0]
+
+
+class CountCache(FileCache):
+    """Counts of characters in files kept between runs, keyed by the options that change what is counted"""
+
+    version = 2
+    table = 'counts'
+    size = COUNT_CACHE_SIZE
+
+    def __init__(self, cache_filename, args):
+        settings = json.dumps({'encoding': args.encoding, 'errors': args.errors,
+                               'line': args.line, 'column': args.column, 'eol': args.eol}, sort_keys=True)
+        super().__init__(cache_filename, settings)
+
+
+def countrange(encoding, errors, input_filename, start, stop):
+    """Count characters in a byte range of the file."""
+
+    count = collections.Counter()
+    decoder = codecs.getincrementaldecoder(encoding)(errors)
+    with open(input_filename, 'rb') as input_file:
+        input_file.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            data = input_file.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            count.update(decoder.decode(data))
+    count.update(decoder.decode(b'', final=True))
+    return count
+
+
 def readfile(options, input_filename):
     """Return each character in the file, or requested subset of the file."""
 
-    with open(input_filename, 'r', encoding=options.args.encoding, errors=options.args.errors, newline='') as input_file:
-        lineno = 0
+    lineno = 0
+    offset = 0
+    if options.args.index and options.args.line > 1 and codecs.lookup(options.args.encoding).name == 'utf-8':
+        offsets = read_line_index(input_filename)
+        checkpoint = min((options.args.line - 1) // LINE_INDEX_INTERVAL, len(offsets) - 1)
+        lineno = checkpoint * LINE_INDEX_INTERVAL
+        offset = offsets[checkpoint]
+
+    with open(input_filename, 'rb') as binary_file:
+        binary_file.seek(offset)
+        input_file = io.TextIOWrapper(binary_file, encoding=options.args.encoding, errors=options.args.errors,
+                                      newline='')
         columnno = 0
         for line in input_file:
             lineno = lineno + 1
@@ -179,6 +793,60 @@ def readfile(options, input_filename):
                 break
 
 
+def read_line_index(input_filename):
+    """Read the byte offsets of every LINE_INDEX_INTERVAL lines, indexing the file again if it has changed."""
+
+    file_stat = os.stat(input_filename)
+    index_filename = input_filename + LINE_INDEX_SUFFIX
+    try:
+        with open(index_filename, 'rb') as index_file:
+            header = LINE_INDEX_HEADER.unpack(index_file.read(LINE_INDEX_HEADER.size))
+            if header == (LINE_INDEX_MAGIC, file_stat.st_size, file_stat.st_mtime_ns, LINE_INDEX_INTERVAL, header[4]):
+                offsets = array.array('Q')
+                offsets.fromfile(index_file, header[4])
+                if sys.byteorder == 'big':
+                    offsets.byteswap()
+                return offsets
+    except (OSError, EOFError, struct.error):
+        pass
+
+    offsets = index_lines(input_filename)
+    header = LINE_INDEX_HEADER.pack(LINE_INDEX_MAGIC, file_stat.st_size, file_stat.st_mtime_ns, LINE_INDEX_INTERVAL,
+                                    len(offsets))
+    if sys.byteorder == 'big':
+        offsets.byteswap()
+    try:
+        with open(index_filename, 'wb') as index_file:
+            index_file.write(header)
+            offsets.tofile(index_file)
+    except OSError:
+        # the index is only an optimization, so files in read-only directories are read without one
+        pass
+    if sys.byteorder == 'big':
+        offsets.byteswap()
+    return offsets
+
+
+def index_lines(input_filename):
+    """Find the byte offsets of every LINE_INDEX_INTERVAL lines in a file using an ASCII compatible encoding."""
+
+    offsets = array.array('Q', [0])
+    # each byte is one character in Latin-1, and the bytes for CR and LF are the same as in UTF-8
+    with open(input_filename, 'r', encoding='latin-1', newline='') as input_file:
+        offset = 0
+        for lineno, line in enumerate(input_file, start=1):
+            offset += len(line)
+            if lineno % LINE_INDEX_INTERVAL == 0:
+                offsets.append(offset)
+    return offsets
+
+
+def formatted(options, cc):
+    """Format the current character for display, reusing the result for recently seen characters."""
+    args = options.args
+    return options.format_cache(cc, args.octets, args.python, args.escape, args.encoding)
+
+
 def format(options, cc):
     """Format the current character for display."""
 
@@ -202,8 +870,7 @@ def usv_format(cc):
 
 def name_format(options, cc):
     """Find name of the character."""
-    usv = cc2usv(cc)
-    return options.ucd.get(usv, "(Unknown)")
+    return options.ucd.get(ord(cc), "(Unknown)")
 
 
 def usv2cc(usv):
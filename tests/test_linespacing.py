@@ -0,0 +1,396 @@
+#!/usr/bin/python3
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+from fontTools.feaLib.builder import addOpenTypeFeaturesFromString
+from fontTools.fontBuilder import FontBuilder
+from fontTools.pens.ttGlyphPen import TTGlyphPen
+from fontTools.ttLib.tables.TupleVariation import TupleVariation
+
+from thefoxUtils import linespacing
+
+FEATURES = '''
+languagesystem DFLT dflt;
+languagesystem dev2 dflt;
+@marks = [acute nukta];
+table GDEF { GlyphClassDef , , @marks, ; } GDEF;
+feature liga { sub b c by b_c; } liga;
+feature calt { sub f' d by f.alt; } calt;
+feature kern { pos a <0 150 0 0>; } kern;
+'''
+
+
+def box(ymin, ymax):
+    pen = TTGlyphPen(None)
+    pen.moveTo((0, ymin))
+    pen.lineTo((0, ymax))
+    pen.lineTo((100, ymax))
+    pen.lineTo((100, ymin))
+    pen.closePath()
+    return pen.glyph()
+
+
+def arch():
+    pen = TTGlyphPen(None)
+    pen.moveTo((0, 0))
+    pen.qCurveTo((50, 101), (100, 0))
+    pen.closePath()
+    return pen.glyph()
+
+
+def build_font(font_filename):
+    """Build a small font with a ligature, a contextual alternate, a vertical adjustment and a mark"""
+
+    glyphs = {'.notdef': box(0, 500), 'space': TTGlyphPen(None).glyph(), 'a': box(0, 700), 'b': box(-100, 600),
+              'c': box(-50, 450), 'd': box(0, 300), 'e': arch(), 'f': box(-200, 400), 'f.alt': box(-600, 400),
+              'b_c': box(-700, 800), 'acute': box(600, 750), 'ka': box(0, 500), 'kha': box(-200, 500),
+              'nukta': box(-900, -800), 'qa': box(-100, 500)}
+    fb = FontBuilder(1000, isTTF=True)
+    fb.setupGlyphOrder(list(glyphs))
+    fb.setupCharacterMap({0x20: 'space', 0x61: 'a', 0x62: 'b', 0x63: 'c', 0x64: 'd', 0x65: 'e', 0x66: 'f',
+                          0x301: 'acute', 0x915: 'ka', 0x916: 'kha', 0x93C: 'nukta', 0x958: 'qa'})
+    fb.setupGlyf(glyphs)
+    fb.setupHorizontalMetrics({glyph_name: (100, 0) for glyph_name in glyphs})
+    fb.setupHorizontalHeader(ascent=800, descent=-200)
+    fb.setupNameTable({'familyName': 'Linespacing Test', 'styleName': 'Regular'})
+    fb.setupOS2()
+    fb.setupPost()
+    addOpenTypeFeaturesFromString(fb.font, FEATURES)
+    fb.save(font_filename)
+
+
+def build_variable_font(font_filename):
+    """Build a font with a weight axis, where a is higher and g is lower when bold, and g is also moved down"""
+
+    glyphs = {'.notdef': box(0, 500), 'space': TTGlyphPen(None).glyph(), 'a': box(0, 700), 'g': box(-200, 500)}
+    fb = FontBuilder(1000, isTTF=True)
+    fb.setupGlyphOrder(list(glyphs))
+    fb.setupCharacterMap({0x20: 'space', 0x61: 'a', 0x67: 'g'})
+    fb.setupGlyf(glyphs)
+    fb.setupHorizontalMetrics({glyph_name: (100, 0) for glyph_name in glyphs})
+    fb.setupHorizontalHeader(ascent=800, descent=-200)
+    fb.setupNameTable({'familyName': 'Linespacing Variable Test', 'styleName': 'Regular'})
+    fb.setupOS2()
+    fb.setupPost()
+    fb.setupFvar([('wght', 100, 400, 900, 'Weight')], [])
+    # the points of a box are its bottom left, top left, top right and bottom right corners, then 4 phantom points
+    bold = {'wght': (0, 1.0, 1.0)}
+    fb.setupGvar({'a': [TupleVariation(bold, [(0, 0), (0, 200), (0, 200), (0, 0)] + [None] * 4)],
+                  'g': [TupleVariation(bold, [(0, -100), (0, 0), (0, 0), (0, -100)] + [None] * 4)]})
+    # g is moved down when bold, by HarfBuzz rather than by its outline
+    addOpenTypeFeaturesFromString(fb.font, 'feature kern { pos g <0 (wght=400:0 wght=900:-50) 0 0>; } kern;')
+    fb.save(font_filename)
+
+
+class LinespacingTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tempdir = tempfile.mkdtemp()
+        cls.font_filename = os.path.join(cls.tempdir, 'test.ttf')
+        build_font(cls.font_filename)
+        # enough words for the texts of a later batch to be pruned,
+        # followed by the highest words, which are only found if pruning allows for the vertical adjustment of a,
+        # and the lowest word, which is only found if pruning allows for the decomposition of U+0958 when shaping
+        rng = random.Random(1)
+        cls.words = [''.join(rng.choice('bcdef') for i in range(rng.randint(1, 6)))
+                     for n in range(3 * linespacing.BATCH_SIZE)]
+        cls.words += ['a\u0301', 'dad', 'ea', '\u0916', '\u0958']
+        cls.text_files = [(cls.tempdir, 'words.txt')]
+        with open(os.path.join(cls.tempdir, 'words.txt'), 'w') as text_file:
+            for start in range(0, len(cls.words), 8):
+                text_file.write(' '.join(cls.words[start:start + 8]) + '\n')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tempdir)
+
+    def helper_records(self, records, levels, highest=False, start=0):
+        extrema_records = linespacing.ExtremaRecords(records, highest)
+        for order, level in enumerate(levels, start):
+            test_word = linespacing.TestWord(f'w{order}', 1, order + 1, 'test.txt')
+            extrema_records.add(level, order, test_word, 'font.ttf')
+        return extrema_records
+
+    def helper_words(self, extremas):
+        return [(extrema.level, extrema.test_word.text) for extrema in extremas]
+
+    # Candidates
+
+    def test_candidates_lowest(self):
+        candidates = linespacing.Candidates(2)
+        for text, level in (('a', 5), ('b', 3), ('c', 7), ('d', 4)):
+            candidates.add(text, level)
+        self.assertEqual({'b': 3, 'd': 4}, candidates.levels())
+
+    def test_candidates_highest(self):
+        candidates = linespacing.Candidates(2, highest=True)
+        for text, level in (('a', 5), ('b', 3), ('c', 7), ('d', 4)):
+            candidates.add(text, level)
+        self.assertEqual({'a': 5, 'c': 7}, candidates.levels())
+
+    def test_candidates_ties(self):
+        candidates = linespacing.Candidates(2)
+        for text, level in (('a', 3), ('b', 2), ('c', 4), ('d', 3), ('e', 3)):
+            candidates.add(text, level)
+        self.assertEqual({'a': 3, 'b': 2, 'd': 3}, candidates.levels())
+        # only the earliest ties can be records
+        candidates = linespacing.Candidates(1)
+        for text, level in (('a', 3), ('b', 3), ('c', 4)):
+            candidates.add(text, level)
+        self.assertEqual({'a': 3}, candidates.levels())
+
+    def test_candidates_ties_order(self):
+        candidates = linespacing.Candidates(1)
+        for text, level, order in (('a', 3, 2), ('b', 3, 1), ('a', 3, 0)):
+            candidates.add(text, level, order)
+        self.assertEqual({'a': 3}, candidates.levels())
+
+    def test_candidates_extremes(self):
+        candidates = linespacing.Candidates(2, extremes=[1, 2, 9])
+        self.assertEqual([1, 2], sorted(candidates.extremes()))
+        self.assertFalse(candidates.reachable(3))
+        candidates.add('a', 1)
+        self.assertEqual({'a': 1}, candidates.levels())
+        self.assertEqual([1, 1], sorted(candidates.extremes()))
+
+    def test_candidates_purge(self):
+        candidates = linespacing.Candidates(2)
+        for level in range(100, 0, -1):
+            candidates.add(str(level), level)
+        self.assertLessEqual(len(candidates.candidates), 4)
+        self.assertEqual({'1': 1, '2': 2}, candidates.levels())
+
+    def test_candidates_reachable(self):
+        candidates = linespacing.Candidates(1, highest=True)
+        self.assertTrue(candidates.reachable(-1000))
+        candidates.add('a', 10)
+        self.assertTrue(candidates.reachable(10))
+        self.assertFalse(candidates.reachable(9))
+        self.assertFalse(linespacing.Candidates(0).reachable(-1000))
+
+    # ExtremaRecords
+
+    def test_records_lowest(self):
+        extrema_records = self.helper_records(2, [5, 3, 7, 1])
+        self.assertEqual([(1, 'w3'), (3, 'w1')], self.helper_words(extrema_records.extremas()))
+
+    def test_records_highest(self):
+        extrema_records = self.helper_records(2, [5, 3, 7, 1], highest=True)
+        self.assertEqual([(7, 'w2'), (5, 'w0')], self.helper_words(extrema_records.extremas()))
+
+    def test_records_ties(self):
+        extrema_records = self.helper_records(2, [3, 3, 3])
+        self.assertEqual([(3, 'w0'), (3, 'w1')], self.helper_words(extrema_records.extremas()))
+
+    def test_records_later_earlier_tie(self):
+        # a tie that occurs earlier replaces a later one, whatever order they are added in
+        extrema_records = linespacing.ExtremaRecords(1)
+        extrema_records.add(3, 5, linespacing.TestWord('later', 1, 6, 'test.txt'), 'font.ttf')
+        self.assertTrue(extrema_records.add(3, 2, linespacing.TestWord('earlier', 1, 3, 'test.txt'), 'font.ttf'))
+        self.assertFalse(extrema_records.add(3, 4, linespacing.TestWord('between', 1, 5, 'test.txt'), 'font.ttf'))
+        self.assertEqual([(3, 'earlier')], self.helper_words(extrema_records.extremas()))
+
+    def test_records_update(self):
+        extrema_records = self.helper_records(3, [5, 3])
+        extrema_records.update(self.helper_records(3, [4, 1, 6], start=10))
+        self.assertEqual([(1, 'w11'), (3, 'w1'), (4, 'w10')], self.helper_words(extrema_records.extremas()))
+
+    def test_records_update_ties(self):
+        # ties between fonts are ordered by font first, as find_extrema orders by font and then position
+        word_count = 100
+        first_font = self.helper_records(2, [3, 3], start=50)
+        second_font = self.helper_records(2, [3, 3], start=word_count + 1)
+        second_font.update(first_font)
+        self.assertEqual([(3, 'w50'), (3, 'w51')], self.helper_words(second_font.extremas()))
+
+    # Arguments
+
+    def test_parse_location(self):
+        self.assertEqual((('wdth', 100.0), ('wght', 700.0)), linespacing.parse_location('wght=700, wdth=100'))
+
+    def test_parse_location_invalid(self):
+        with self.assertRaises(argparse.ArgumentTypeError):
+            linespacing.parse_location('wght')
+
+    def test_parse_grid(self):
+        self.assertEqual(('wght', [100.0, 200.0, 300.0]), linespacing.parse_grid('wght=100:300:100'))
+        self.assertEqual(('wdth', [75.0, 87.5, 100.0]), linespacing.parse_grid('wdth=75:100:12.5'))
+        # rounding does not lose the last value
+        self.assertEqual(3, len(linespacing.parse_grid('opsz=0.1:0.3:0.1')[1]))
+
+    def test_parse_grid_invalid(self):
+        for grid in ('wght=100:900', 'wght=100:900:0', 'wght'):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                linespacing.parse_grid(grid)
+
+    def test_grid_locations(self):
+        locations = linespacing.grid_locations([('wght', [400.0, 700.0]), ('wdth', [100.0])])
+        self.assertEqual([(('wdth', 100.0), ('wght', 400.0)), (('wdth', 100.0), ('wght', 700.0))], locations)
+        self.assertEqual([], linespacing.grid_locations([]))
+
+    # Pruning
+
+    def helper_levels(self, results, records):
+        lowest = linespacing.Candidates(records)
+        highest = linespacing.Candidates(records, highest=True)
+        for index, result in enumerate(results):
+            if result is not linespacing.PRUNED and result is not None:
+                lowest.add(index, result[0])
+                highest.add(index, result[1])
+        return lowest.levels(), highest.levels()
+
+    def test_prune_texts(self):
+        unpruned = linespacing.measure_texts(self.font_filename, self.words)
+        pruned = linespacing.measure_texts(self.font_filename, self.words, records=3)
+        self.assertIn(linespacing.PRUNED, pruned)
+        self.assertNotIn(linespacing.PRUNED, unpruned)
+        self.assertEqual(self.helper_levels(unpruned, 3), self.helper_levels(pruned, 3))
+
+    def test_prune_extrema(self):
+        for lines in (False, True):
+            found = []
+            for prune in (False, True):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    lowest, highest, font_extremas = linespacing.find_extrema(self.text_files, [self.font_filename], 3,
+                                                                              lines=lines, prune=prune)
+                found.append([extrema.report() for extrema in lowest + highest])
+            self.assertEqual(found[0], found[1])
+            self.assertEqual(6, len(found[0]))
+
+    def test_jobs(self):
+        for lines in (False, True):
+            found = []
+            for jobs in (1, 2):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    lowest, highest, font_extremas = linespacing.find_extrema(self.text_files, [self.font_filename], 3,
+                                                                              jobs=jobs, lines=lines)
+                font_reports = {instance: [extrema.report() for extrema in font_lowest + font_highest]
+                                for instance, (font_lowest, font_highest) in font_extremas.items()}
+                found.append(([extrema.report() for extrema in lowest + highest], font_reports))
+            self.assertEqual(found[0], found[1])
+            self.assertEqual(6, len(found[0][0]))
+
+    def test_line_batches(self):
+        # lines that occur again in a later batch
+        text_files = self.text_files * 2
+        batches = list(linespacing.read_texts(text_files, lines=True, batch_lines=100))
+        self.assertEqual([100] * 7 + [52], [len(texts) for texts, word_count in batches])
+        self.assertEqual(2 * len(self.words), sum(word_count for texts, word_count in batches))
+        for prune in (False, True):
+            found = []
+            for batch_lines in (linespacing.LINE_BATCH_SIZE, 100):
+                with unittest.mock.patch.object(linespacing, 'LINE_BATCH_SIZE', batch_lines):
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        lowest, highest, font_extremas = linespacing.find_extrema(text_files, [self.font_filename], 3,
+                                                                                  lines=True, prune=prune)
+                found.append([extrema.report() for extrema in lowest + highest])
+            self.assertEqual(found[0], found[1])
+
+    def test_line_ties_cached(self):
+        # the texts found in the cache, which are measured first, are the later lines
+        with open(os.path.join(self.tempdir, 'words.txt')) as text_file:
+            later_lines = text_file.readlines()[100:]
+        with open(os.path.join(self.tempdir, 'later.txt'), 'w') as text_file:
+            text_file.writelines(later_lines)
+        cache = linespacing.ShapingCache(os.path.join(self.tempdir, 'ties.sqlite'), linespacing.shaping_settings(True))
+        found = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            linespacing.find_extrema([(self.tempdir, 'later.txt')], [self.font_filename], 1, cache=cache, lines=True)
+            for use_cache in (None, cache):
+                lowest, highest, font_extremas = linespacing.find_extrema(self.text_files, [self.font_filename], 1,
+                                                                          cache=use_cache, lines=True)
+                found.append([extrema.report() for extrema in lowest + highest])
+        cache.close()
+        self.assertEqual(found[0], found[1])
+
+    # Axis locations
+
+    def test_locate(self):
+        font_filename = os.path.join(self.tempdir, 'variable.ttf')
+        build_variable_font(font_filename)
+        bold = (('wght', 900.0),)
+        shaper = linespacing.Shaper(font_filename)
+        gid = shaper.font.getGlyphID('a')
+        glyph_bounds = shaper.locate(bold)
+        self.assertEqual(900, glyph_bounds[gid][3])
+        self.assertIs(glyph_bounds, shaper.locate(bold))
+        self.assertEqual(700, shaper.locate(())[gid][3])
+        self.assertEqual(900, linespacing.GlyphBounds(shaper.font, bold)[gid][3])
+        # shaping uses the location it was given
+        self.assertEqual((0, 900), linespacing.measure_texts(font_filename, ['a'], location=bold)[0])
+        self.assertEqual((0, 700), linespacing.measure_texts(font_filename, ['a'])[0])
+        self.assertEqual((-350, 450), linespacing.measure_texts(font_filename, ['g'], location=bold)[0])
+
+    def test_show_locations(self):
+        font_filename = os.path.join(self.tempdir, 'show.ttf')
+        build_variable_font(font_filename)
+        with open(os.path.join(self.tempdir, 'ag.txt'), 'w') as text_file:
+            text_file.write('a g\n')
+        locations = [(), (('wght', 900.0),)]
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            lowest, highest, font_extremas = linespacing.find_extrema([(self.tempdir, 'ag.txt')], [font_filename], 1,
+                                                                      locations=locations)
+            linespacing.show(lowest, highest, font_extremas, [font_filename], locations)
+        self.assertEqual([-350, 900], [lowest[0].level, highest[0].level])
+        rows = {line.split()[0]: line.split()[1:] for line in output.getvalue().splitlines()}
+        root = os.path.splitext(font_filename)[0]
+        self.assertEqual([root, root, 'wght=900'], rows['Field'])
+        self.assertEqual(['700', '900'], rows['HIGHEST'])
+        self.assertEqual(['-200', '-350'], rows['LOWEST'])
+
+    # Cache
+
+    def test_shaping_cache(self):
+        font_filename = os.path.join(self.tempdir, 'cached.ttf')
+        shutil.copy(self.font_filename, font_filename)
+        cache_filename = os.path.join(self.tempdir, 'shaping.sqlite')
+        settings = linespacing.shaping_settings()
+        cache = linespacing.ShapingCache(cache_filename, settings)
+        extents = [(-100, 600), None, linespacing.PRUNED]
+        cache.write(font_filename, (), ['b', 'a\u0301', 'c'], extents)
+        self.assertEqual({'b': [-100, 600], 'a\u0301': None}, cache.read(font_filename, (), ['b', 'a\u0301', 'c']))
+        self.assertEqual({}, cache.read(font_filename, (('wght', 700.0),), ['b']))
+        old_hash = cache.font_hash(font_filename)
+        cache.close()
+
+        with open(font_filename, 'ab') as font_file:
+            font_file.write(b'\0')
+        cache = linespacing.ShapingCache(cache_filename, settings)
+        self.assertEqual({}, cache.read(font_filename, (), ['b', 'a\u0301']))
+        rows = cache.connection.execute('SELECT COUNT(*) FROM extents WHERE font_hash = ?', (old_hash,)).fetchone()
+        self.assertEqual(0, rows[0])
+        cache.close()
+
+    # Measuring
+
+    @unittest.skipIf(linespacing.numpy is None, 'needs NumPy')
+    def test_measure_batch(self):
+        # the arch of e has bounds that are not integers, the levels of the other glyphs stay integers
+        shaper = linespacing.Shaper(self.font_filename)
+        glyph_bounds = shaper.locate(())
+        texts = self.words[:100] + ['e', 'de']
+        expected = [linespacing.word_extent(shaper.hb_font, glyph_bounds, text) for text in texts]
+        self.assertEqual(repr(expected), repr(linespacing.measure_batch(shaper.hb_font, glyph_bounds, texts)))
+        line = ' '.join(texts)
+        expected = [linespacing.line_extents(shaper.hb_font, glyph_bounds, line)]
+        self.assertEqual(repr(expected), repr(linespacing.measure_batch(shaper.hb_font, glyph_bounds, [line], True)))
+
+    # Words
+
+    def test_find_word_starts(self):
+        self.assertEqual([0, 3, 6], linespacing.find_word_starts('ab cd e'))
+        self.assertEqual([0], linespacing.find_word_starts('word'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,14 @@
 #!/usr/bin/python3
 
+import argparse
+import contextlib
+import io
 import os
+import shutil
+import sqlite3
 import sys
+import tempfile
+import threading
 import unittest
 
 from thefoxUtils import tf
@@ -12,8 +19,10 @@ class TextFileTests(unittest.TestCase):
     def setUp(self):
         os.chdir('tests/data/tf')
         self.version = sys.version_info
+        self.tempdir = tempfile.mkdtemp()
 
     def tearDown(self):
+        shutil.rmtree(self.tempdir)
         os.chdir('../../..')
 
     # Line endings
@@ -42,6 +51,108 @@ class TextFileTests(unittest.TestCase):
         filename = 'change_os.rawtxt'
         self.assertEqual('nl: dos unix ws: eof', tf.process_file(None, None, None, filename))
 
+    @unittest.skipUnless(hasattr(os, 'mkfifo'), 'needs named pipes')
+    def test_pipe(self):
+        filename = os.path.join(self.tempdir, 'pipe')
+        os.mkfifo(filename)
+        writer = threading.Thread(target=self.helper_write, args=(filename, 'a \r\n'))
+        writer.start()
+        self.assertEqual('nl: dos ws: eol', tf.process_file(None, None, None, filename))
+        writer.join()
+
+    def helper_write(self, filename, text):
+        with open(filename, 'w', newline='') as output_file:
+            output_file.write(text)
+
+    # Files
+
+    def test_process_files_jobs(self):
+        filename = os.path.join(self.tempdir, 'dos.rawtxt')
+        shutil.copy('dos.rawtxt', filename)
+        mac_filename = os.path.join(self.tempdir, 'mac.rawtxt')
+        shutil.copy('mac.rawtxt', mac_filename)
+        args = argparse.Namespace(requested_eol=tf.UNIX, requested_nf=None, whitespace=False, jobs=2,
+                                  file=[filename, mac_filename, filename], directories=[], cache=None)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            tf.process_files(args)
+        self.assertEqual([f'{filename}: nl: dos ws: eol',
+                          f'{mac_filename}: nl: mac',
+                          f'{filename}: ws: eol'], output.getvalue().splitlines())
+
+    def test_find_files(self):
+        found = list(tf.find_files('.', ['*.rawtxt'], ['missing-*']))
+        self.assertIn(os.path.join('.', 'dos.rawtxt'), found)
+        self.assertNotIn(os.path.join('.', 'missing-dos.rawtxt'), found)
+        self.assertNotIn(os.path.join('.', 'nf-c.txt'), found)
+
+    def test_process_files_cache(self):
+        args = argparse.Namespace(requested_eol=None, requested_nf=None, whitespace=False, jobs=1,
+                                  file=[], directories=['.'], include=['mac.rawtxt'], exclude=[],
+                                  cache=os.path.join(self.tempdir, 'tf.sqlite'))
+        cache = tf.ReportCache(args.cache, args)
+        self.assertIsNone(cache.read('mac.rawtxt'))
+        cache.write('mac.rawtxt', 'from the cache')
+        cache.save()
+        cache.close()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            tf.process_files(args)
+        self.assertEqual(os.path.join('.', 'mac.rawtxt') + ': from the cache\n', output.getvalue())
+
+    def test_report_cache_locked(self):
+        args = argparse.Namespace(requested_eol=None, requested_nf=None, whitespace=False)
+        cache_filename = os.path.join(self.tempdir, 'tf.sqlite')
+        cache = tf.ReportCache(cache_filename, args)
+        cache.connection.execute('PRAGMA busy_timeout = 0')
+        self.assertIsNone(cache.read('mac.rawtxt'))
+        cache.write('mac.rawtxt', 'nl: mac')
+        other = sqlite3.connect(cache_filename)
+        other.execute('BEGIN IMMEDIATE')
+        errors = io.StringIO()
+        with contextlib.redirect_stderr(errors):
+            cache.save()
+        other.rollback()
+        other.close()
+        self.assertIn('carrying on without the cache', errors.getvalue())
+        self.assertIsNone(cache.read('mac.rawtxt'))
+        cache.close()
+
+    def test_report_cache_size(self):
+        args = argparse.Namespace(requested_eol=None, requested_nf=None, whitespace=False)
+        cache = tf.ReportCache(os.path.join(self.tempdir, 'tf.sqlite'), args)
+        for filename in ('dos.rawtxt', 'mac.rawtxt', 'unix.rawtxt'):
+            cache.read(filename)
+            cache.write(filename, filename)
+            cache.save()
+        cache.prune('reports', 2)
+        self.assertEqual(2, cache.connection.execute('SELECT COUNT(*) FROM reports').fetchone()[0])
+        cache.close()
+
+    # Conversions
+
+    def test_convert_unchanged(self):
+        filename = os.path.join(self.tempdir, 'unix.rawtxt')
+        shutil.copy2('unix.rawtxt', filename)
+        before = os.stat(filename)
+        self.assertEqual('ws: eol eof', tf.process_file(tf.UNIX, None, None, filename))
+        after = os.stat(filename)
+        self.assertEqual((before.st_ino, before.st_ctime_ns), (after.st_ino, after.st_ctime_ns))
+
+    def test_convert_changed(self):
+        filename = os.path.join(self.tempdir, 'dos.rawtxt')
+        shutil.copy2('dos.rawtxt', filename)
+        os.chmod(filename, 0o640)
+        before = os.stat(filename)
+        self.assertEqual('nl: dos ws: eol', tf.process_file(tf.UNIX, None, None, filename))
+        after = os.stat(filename)
+        self.assertEqual(before.st_mtime_ns, after.st_mtime_ns)
+        if os.name == 'posix':
+            # other systems only keep whether the file is read-only
+            self.assertEqual(0o640, after.st_mode & 0o777)
+        self.assertEqual('ws: eol', tf.process_file(None, None, None, filename))
+        self.assertEqual(['dos.rawtxt'], os.listdir(self.tempdir))
+
     # Normalization forms
 
     def helper_nf(self, expected):
@@ -70,6 +181,13 @@ class TextFileTests(unittest.TestCase):
         filename = 'nf-none.txt'
         self.assertEqual(self.helper_nf('nf:'), tf.process_file(None, None, None, filename))
 
+    def test_is_normalized_ascii(self):
+        self.assertTrue(tf.is_normalized('NFD', 'resume'))
+
+    def test_is_normalized(self):
+        self.assertTrue(tf.is_normalized('NFC', u'r\u00e9sum\u00e9'))
+        self.assertFalse(tf.is_normalized('NFD', u'r\u00e9sum\u00e9'))
+
     def test_nfc_tus1(self):
         text = u'e\u0301'
         self.assertEqual(u'\u00e9', tf.normalize('NFC', text))
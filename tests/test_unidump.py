@@ -1,22 +1,47 @@
 #!/usr/bin/python3
 
+import lzma
 import os
 import os.path
+import contextlib
+import io
+import shutil
+import socket
+import tempfile
+import threading
 import unittest
+import unittest.mock
 
 from thefoxUtils import unidump
 
 
 class UnidumpTests(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        cls.tempdir = tempfile.mkdtemp()
+        data = os.path.join('tests', 'data', 'unidump')
+        unicode_data = os.path.join(cls.tempdir, 'UnicodeData.txt')
+        with lzma.open(os.path.join(data, 'UnicodeData-names.txt.xz')) as compressed:
+            with open(unicode_data, 'wb') as uncompressed:
+                shutil.copyfileobj(compressed, uncompressed)
+        cls.ucd_cache = os.path.join(cls.tempdir, 'ucd.bin')
+        pua = [os.path.join(data, pua_filename) for pua_filename in ('branch.txt', 'microsoft.txt', 'sil.txt')]
+        unidump.update_ucd([unicode_data] + pua, cls.ucd_cache)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tempdir)
+
     def setUp(self):
         os.chdir('tests/data/unidump')
-        ucd = unidump.read_ucd("ucd.pickle.xz")
+        ucd = unidump.read_ucd(self.ucd_cache)
         parser = unidump.cmdline()
         args = parser.parse_args(["/dev/null"])
         self.options = unidump.Options(args, ucd)
 
     def tearDown(self):
+        self.options.ucd.close()
         os.chdir('../../..')
 
     # The two ignored tests pass on Ubuntu 9.04 with Python 2.6,
@@ -76,6 +101,129 @@ class UnidumpTests(unittest.TestCase):
         self.assertEqual(4, count['4'], 'four')
         self.assertEqual(6, count['e'], 'letter e')
 
+    def test_countFileSlow(self):
+        fast = dict()
+        unidump.countfile(self.options, fast, "position.txt")
+        slow = dict()
+        self.options.args.debug = True
+        unidump.countfile(self.options, slow, "position.txt")
+        self.assertEqual(fast, slow)
+
+    def test_posLineIndex(self):
+        input_filename = os.path.join(self.tempdir, 'lines.txt')
+        with open(input_filename, 'w', encoding='utf-8', newline='') as input_file:
+            for lineno in range(1, 3000):
+                input_file.write(f'\u00e9{lineno}' + ('\r\n', '\r', '\n')[lineno % 3])
+        self.options.args.eol = True
+        for line in (1, 999, 1000, 1001, 2000, 2999):
+            self.options.args.line = line
+            self.options.args.index = False
+            expected = ''.join(unidump.readfile(self.options, input_filename))
+            self.options.args.index = True
+            self.assertEqual(expected, ''.join(unidump.readfile(self.options, input_filename)))
+        self.assertTrue(os.path.exists(input_filename + unidump.LINE_INDEX_SUFFIX))
+
+    # server
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'needs Unix domain sockets')
+    def test_client(self):
+        socket_filename = os.path.join(self.tempdir, 'socket')
+        ucd = unidump.read_ucd(self.ucd_cache)
+        with unidump.make_server(ucd, socket_filename) as server:
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    self.assertTrue(unidump.client(socket_filename, ["--count", "position.txt"]))
+            finally:
+                server.shutdown()
+                thread.join()
+        ucd.close()
+        self.assertIn("      3 U+0065 LATIN SMALL LETTER E\n", output.getvalue())
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'needs Unix domain sockets')
+    def test_serverReread(self):
+        pua_filename, ucd_cache = self.helper_ucd('server')
+        socket_filename = os.path.join(self.tempdir, 'server-socket')
+        with unidump.make_server(unidump.read_ucd(ucd_cache), socket_filename) as server:
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    self.assertTrue(unidump.client(socket_filename, ["--quote", "E000"]))
+                    with open(pua_filename, 'w') as pua_file:
+                        pua_file.write('E000;NEW NAME;;;;;;;;;;;;;\n')
+                    unidump.update_ucd([pua_filename], ucd_cache)
+                    self.assertTrue(unidump.client(socket_filename, ["--quote", "E000"]))
+            finally:
+                server.shutdown()
+                thread.join()
+                server.options.ucd.close()
+        self.assertEqual(["OLD NAME", "NEW NAME"], [line.split(' ', 1)[1] for line in output.getvalue().splitlines()])
+
+    def test_clientNoServer(self):
+        self.assertFalse(unidump.client(os.path.join(self.tempdir, 'missing'), ["position.txt"]))
+
+    def test_noUnixSockets(self):
+        socket_filename = os.path.join(self.tempdir, 'socket')
+        with unittest.mock.patch.object(unidump, 'socket', object()):
+            self.assertFalse(unidump.client(socket_filename, ["position.txt"]))
+            with self.assertRaises(SystemExit):
+                unidump.serve(self.ucd_cache, socket_filename)
+
+    # format
+
+    def test_formatted(self):
+        self.options.args.octets = True
+        self.assertEqual(unidump.format(self.options, "\u00F1"), unidump.formatted(self.options, "\u00F1"))
+        unidump.formatted(self.options, "\u00F1")
+        self.assertEqual(1, self.options.format_cache.cache_info().hits)
+
+    def test_formattedOptions(self):
+        self.assertEqual("U+0041 LATIN CAPITAL LETTER A", unidump.formatted(self.options, "A"))
+        self.options.args.octets = True
+        self.assertEqual("0x41                U+0041 LATIN CAPITAL LETTER A", unidump.formatted(self.options, "A"))
+
+    def test_countFilesParallel(self):
+        self.options.args.jobs = 2
+        self.options.args.file = ["position.txt", os.path.join("..", "tf", "nf-none.txt")]
+        file_counts = unidump.countfiles_parallel(self.options, self.options.args.file)
+        for input_filename in self.options.args.file:
+            expected = dict()
+            unidump.countfile(self.options, expected, input_filename)
+            self.assertEqual(expected, file_counts[input_filename])
+
+    def test_countCache(self):
+        input_filename = os.path.join(self.tempdir, 'count.txt')
+        with open(input_filename, 'w') as input_file:
+            input_file.write('aab')
+        cache = unidump.CountCache(os.path.join(self.tempdir, 'counts.sqlite'), self.options.args)
+        self.assertIsNone(cache.read(input_filename))
+        cache.write(input_filename, {'a': 2, 'b': 1})
+        cache.save()
+        self.assertEqual({'a': 2, 'b': 1}, cache.read(input_filename))
+        # reading does not hold the cache locked until the end of the run
+        self.assertFalse(cache.connection.in_transaction)
+        # tf keeps the modification time of the files it converts
+        before = os.stat(input_filename)
+        with open(input_filename, 'w') as input_file:
+            input_file.write('abb')
+        os.utime(input_filename, ns=(before.st_atime_ns, before.st_mtime_ns))
+        # the change time can be kept by a coarse clock
+        while os.stat(input_filename).st_ctime_ns == before.st_ctime_ns:
+            os.utime(input_filename, ns=(before.st_atime_ns, before.st_mtime_ns))
+        self.assertIsNone(cache.read(input_filename))
+        cache.close()
+
+    def test_byteRanges(self):
+        input_filename = os.path.join("..", "tf", "nf-none.txt")
+        with open(input_filename, 'rb') as input_file:
+            data = input_file.read()
+        ranges = unidump.byte_ranges(input_filename, 7)
+        self.assertEqual(data.decode('utf-8'), ''.join(data[start:stop].decode('utf-8') for start, stop in ranges))
+
     # usv
 
     def test_usvLatin1(self):
@@ -193,6 +341,109 @@ class UnidumpTests(unittest.TestCase):
     def test_nameLowSurrogate(self):
         self.assertEqual("Low Surrogate-DC00", unidump.name_format(self.options, "\uDC00"))
 
+    def test_nameUnknown(self):
+        self.assertEqual("(Unknown)", unidump.name_format(self.options, "\U0010FFFF"))
+
+    def test_nameFirst(self):
+        self.assertEqual("(NULL)", unidump.name_format(self.options, "\u0000"))
+
+    def test_addRange(self):
+        names = {0xE000: "EARLIER", 0xF000: "KEPT"}
+        ranges = [(0xE000, 0xF8FF, "Private Use")]
+        unidump.add_range(names, ranges, 0xE000, 0xE0FF, "BRANCH PUA")
+        self.assertEqual({0xF000: "KEPT"}, names)
+        self.assertEqual([(0xE000, 0xE0FF, "BRANCH PUA"), (0xE100, 0xF8FF, "Private Use")], ranges)
+
+    # cache
+
+    def test_ucdSources(self):
+        sources = self.options.ucd.sources['sources']
+        self.assertEqual(['UnicodeData.txt', 'branch.txt', 'microsoft.txt', 'sil.txt'],
+                         [os.path.basename(source['path']) for source in sources])
+        self.assertEqual(([], {}, []), self.options.ucd.check_sources())
+        umask = os.umask(0)
+        os.umask(umask)
+        self.assertEqual(0o666 & ~umask, os.stat(self.ucd_cache).st_mode & 0o777)
+
+    def test_ucdChanged(self):
+        cache_dir = os.path.join(self.tempdir, 'changed')
+        os.mkdir(cache_dir)
+        pua_filename = os.path.join(cache_dir, 'pua.txt')
+        with open(pua_filename, 'w') as pua_file:
+            pua_file.write('E000;OLD NAME;;;;;;;;;;;;;\n')
+        ucd_cache = os.path.join(cache_dir, 'ucd.bin')
+        unidump.update_ucd([pua_filename], ucd_cache)
+        with open(pua_filename, 'w') as pua_file:
+            pua_file.write('E000;NEW NAME;;;;;;;;;;;;;\n')
+        # the same size as before, so make sure the change is noticed even if the time has not changed
+        os.utime(pua_filename, ns=(0, 0))
+        ucd = unidump.read_ucd(ucd_cache)
+        self.assertEqual("NEW NAME", ucd.get(0xE000))
+        ucd.close()
+        self.assertEqual(1, len(os.listdir(os.path.join(cache_dir, 'layers'))))
+
+    def helper_ucd(self, name):
+        cache_dir = os.path.join(self.tempdir, name)
+        os.mkdir(cache_dir)
+        pua_filename = os.path.join(cache_dir, 'pua.txt')
+        with open(pua_filename, 'w') as pua_file:
+            pua_file.write('E000;OLD NAME;;;;;;;;;;;;;\n')
+        ucd_cache = os.path.join(cache_dir, 'ucd.bin')
+        unidump.update_ucd([pua_filename], ucd_cache)
+        return pua_filename, ucd_cache
+
+    def test_ucdTouched(self):
+        pua_filename, ucd_cache = self.helper_ucd('touched')
+        os.utime(pua_filename, ns=(0, 0))
+        unidump.read_ucd(ucd_cache).close()
+        ucd = unidump.read_ucd(ucd_cache)
+        self.assertEqual(0, ucd.sources['sources'][0]['mtime_ns'])
+        self.assertEqual(([], {}, []), ucd.check_sources())
+        self.assertEqual("OLD NAME", ucd.get(0xE000))
+        ucd.close()
+
+    def test_ucdMissing(self):
+        pua_filename, ucd_cache = self.helper_ucd('missing')
+        os.remove(pua_filename)
+        errors = io.StringIO()
+        with contextlib.redirect_stderr(errors):
+            unidump.read_ucd(ucd_cache).close()
+            ucd = unidump.read_ucd(ucd_cache)
+        self.assertEqual(1, errors.getvalue().count('is missing'))
+        self.assertEqual("OLD NAME", ucd.get(0xE000))
+        ucd.close()
+
+    def test_ucdUpdateFails(self):
+        pua_filename, ucd_cache = self.helper_ucd('fails')
+        with open(pua_filename, 'w') as pua_file:
+            pua_file.write('E000;NEW NAME;;;;;;;;;;;;;\n')
+        # the layers of the sources cannot be kept
+        layers_dir = os.path.join(os.path.dirname(ucd_cache), 'layers')
+        shutil.rmtree(layers_dir)
+        open(layers_dir, 'w').close()
+        errors = io.StringIO()
+        with contextlib.redirect_stderr(errors):
+            ucd = unidump.read_ucd(ucd_cache)
+        self.assertIn('cannot update the UCD cache', errors.getvalue())
+        self.assertEqual("OLD NAME", ucd.get(0xE000))
+        ucd.close()
+
+    # find
+
+    def test_find(self):
+        self.assertEqual([0x00F1, 0x0144, 0x0146, 0x0148], self.options.ucd.find("latin small n with")[:4])
+
+    def test_findRange(self):
+        found = self.options.ucd.find("pua branch")
+        self.assertIn(0xE000, found)
+        self.assertEqual(["BRANCH PUA-E000"], [self.options.ucd.get(codepoint) for codepoint in found[:1]])
+
+    def test_findShadowed(self):
+        self.assertNotIn(0xE000, self.options.ucd.find("private use"))
+
+    def test_findNothing(self):
+        self.assertEqual([], self.options.ucd.find("no such words"))
+
     # octets
 
     def test_octetsControl(self):